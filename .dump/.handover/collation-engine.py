@@ -3,93 +3,386 @@ import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext
 from datetime import datetime
 import threading
-import re
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import time
+import queue
+import sqlite3
+from functools import partial
+from collation_engine import (
+    CACHE_FILE_NAME, CONTENT_FILE_NAMES, DEFAULT_BATCH_SIZE, DEFAULT_IGNORES, DEFAULT_SIZE_LIMIT, FILES_TO_IGNORE,
+    NON_TEXT_KINDS, PROFILES_FILE_NAME, CollationCancelled, CollationOptions, DirectorySnapshot, GitError, IgnoreMatcher,
+    Instrumentation, PathIndex, ResultCache, SelectionProfiles, collate,
+)
+
+# Profile the selection is saved under on every Save
+LAST_SAVE_PROFILE = "Last save"
+# A batch of file system events larger than this is applied as a rescan
+MAX_FS_EVENTS = 2000
+# Search matches shown in the tree at once; Select Matches takes all of them
+MAX_SEARCH_ROWS = 500
 
 class FileCheckboxTree(ttk.Frame):
+    # Rows are drawn by a ttk.Treeview, which only renders what is visible, and
+    # a directory's children are only inserted into it the first time that
+    # directory is opened. Check state lives in a bytearray indexed by node id
+    # instead of a BooleanVar and Checkbutton per file. The parents/children
+    # lists double as the index used for subtree toggles, so a directory
+    # toggle touches its own subtree and ancestors only. Directories are
+    # tri-state: checked, unchecked, or partial when only some of their
+    # selectable descendants are checked. Directories added with loaded=False
+    # have not been scanned yet: opening one calls load_callback(key), and the
+    # owner adds the children and calls mark_loaded(key) when they arrive.
+    UNCHECKED = "☐"
+    CHECKED = "☑"
+    PARTIAL = "◪"
+
     def __init__(self, master, **kwargs):
         super().__init__(master, **kwargs)
         
-        # Create canvas and scrollbar
-        self.canvas = tk.Canvas(self, borderwidth=0)
-        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
-        self.scrollable_frame = ttk.Frame(self.canvas)
-        
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-        
-        # Bind mouse wheel
-        self.canvas.bind_all("<MouseWheel>", self._on_mousewheel)
+        # Create tree and scrollbar
+        self.tree = ttk.Treeview(self, show="tree", selectmode="browse")
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.scrollbar.set)
+        self.tree.tag_configure("disabled", foreground="gray")
         
         # Layout
         self.scrollbar.pack(side="right", fill="y")
-        self.canvas.pack(side="left", fill="both", expand=True)
+        self.tree.pack(side="left", fill="both", expand=True)
+        
+        self.tree.bind("<<TreeviewOpen>>", self._on_open)
+        self.tree.bind("<Button-1>", self._on_click)
+        self.tree.bind("<space>", self._on_space)
+        
+        self.load_callback = None
+        self._reset()
         
-        self.canvas_frame = self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.scrollable_frame.bind("<Configure>", self._configure_scroll_region)
-        self.canvas.bind("<Configure>", self._configure_canvas_window)
+    def _reset(self):
+        self.keys = []  # Node id -> path, None once removed
+        self.labels = []
+        self.parents = []
+        self.children = []  # Node id -> child ids in display order
+        self.roots = []
+        self.ids = {}
+        self.checked = bytearray()
+        self.disabled = bytearray()
+        self.is_dir = bytearray()
+        self.shown = bytearray()  # Node has a row in the Treeview
+        self.populated = bytearray()  # Directory's children have rows
+        self.loaded = bytearray()  # Directory's children are known
+        self.loading = set()
         
-        self.checkboxes = {}
-        self.vars = {}
-        self.disabled_checkboxes = {}
-        self.directories = set()  # Track directory paths
+    def clear(self):
+        self.tree.delete(*self.tree.get_children())
+        self._reset()
         
-    def _on_mousewheel(self, event):
-        self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+    def set_filter(self, keys):
+        # Shows only keys and their ancestors, opened, or the whole tree again
+        # for None. Ancestors count as populated while filtered, so opening
+        # one does not bring back the rows the filter left out.
+        self.tree.delete(*self.tree.get_children())
+        self.shown = bytearray(len(self.keys))
+        self.populated = bytearray(len(self.keys))
+        if keys is None:
+            for node in self.roots:
+                self._show(node)
+            return
+        for key in keys:
+            node = self.ids.get(key)
+            chain = []
+            while node is not None and node >= 0 and not self.shown[node]:
+                chain.append(node)
+                node = self.parents[node]
+            for current in reversed(chain):
+                parent = self.parents[current]
+                if parent >= 0 and not self.populated[parent]:
+                    self.populated[parent] = 1
+                    if self.tree.exists(self._placeholder(parent)):
+                        self.tree.delete(self._placeholder(parent))
+                    self.tree.item(str(parent), open=True)
+                self._show(current)
         
-    def _configure_scroll_region(self, event):
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+    def _text(self, node):
+        mark = (self.UNCHECKED, self.CHECKED, self.PARTIAL)[self.checked[node]]
+        return f"{mark} {self.labels[node]}"
         
-    def _configure_canvas_window(self, event):
-        self.canvas.itemconfig(self.canvas_frame, width=event.width)
+    def _placeholder(self, node):
+        return f"placeholder-{node}"
         
-    def clear(self):
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-        self.checkboxes = {}
-        self.vars = {}
-        self.disabled_checkboxes = {}
-        self.directories = set()
-        
-    def add_item(self, key, display_text, indent=0, disabled=False, is_directory=False):
-        var = tk.BooleanVar()
-        var.trace_add("write", lambda *args, k=key: self.on_checkbox_toggle(k))
-        checkbox = ttk.Checkbutton(
-            self.scrollable_frame,
-            text=display_text,
-            variable=var,
-            padding=(indent*20, 0, 0, 0),
-            state="disabled" if disabled else "normal"
-        )
-        checkbox.pack(anchor="w", fill="x")
-        self.checkboxes[key] = checkbox
-        self.vars[key] = var
-        if disabled:
-            self.disabled_checkboxes[key] = checkbox
-        if is_directory:
-            self.directories.add(key)
+    def _show(self, node, index="end"):
+        parent = self.parents[node]
+        self.tree.insert("" if parent < 0 else str(parent), index, iid=str(node), text=self._text(node),
+                         tags=("disabled",) if self.disabled[node] else ())
+        self.shown[node] = 1
+        if self.is_dir[node] and (self.children[node] or not self.loaded[node]):
+            # Gives the row an expand arrow without materialising the children
+            self.tree.insert(str(node), "end", iid=self._placeholder(node))
+        
+    def _populate(self, node):
+        if self.populated[node]:
+            return
+        if not self.loaded[node]:
+            if node not in self.loading and self.load_callback is not None:
+                self.loading.add(node)
+                self.tree.item(self._placeholder(node), text="Loading…")
+                self.load_callback(self.keys[node])
+            return
+        self.populated[node] = 1
+        if self.tree.exists(self._placeholder(node)):
+            self.tree.delete(self._placeholder(node))
+        for child in self.children[node]:
+            if not self.shown[child]:  # Already there if a search showed it
+                self._show(child)
+            
+    def _on_open(self, event):
+        focus = self.tree.focus()
+        if focus.isdigit():
+            self._populate(int(focus))
+            
+    def _on_click(self, event):
+        row = self.tree.identify_row(event.y)
+        if not row.isdigit():
+            return
+        # Leave clicks on the expand arrow to the Treeview
+        if "indicator" in self.tree.identify_element(event.x, event.y):
+            return
+        self.toggle(int(row))
+        
+    def _on_space(self, event):
+        focus = self.tree.focus()
+        if focus.isdigit():
+            self.toggle(int(focus))
+        return "break"
+        
+    def add_item(self, key, display_text, indent=0, disabled=False, is_directory=False, before=None, checked=False,
+                 loaded=True):
+        # indent is implied by the Treeview hierarchy and kept for callers
+        node = len(self.keys)
+        parent = self.ids.get(os.path.dirname(key), -1)
+        self.keys.append(key)
+        self.labels.append(display_text)
+        self.parents.append(parent)
+        self.children.append([] if is_directory else None)
+        self.ids[key] = node
+        self.checked.append(1 if checked and not disabled else 0)
+        self.disabled.append(1 if disabled else 0)
+        self.is_dir.append(1 if is_directory else 0)
+        self.shown.append(0)
+        self.populated.append(0)
+        self.loaded.append(1 if loaded or not is_directory else 0)
+        
+        siblings = self.roots if parent < 0 else self.children[parent]
+        position = len(siblings)
+        if before in self.ids and self.ids[before] in siblings:
+            position = siblings.index(self.ids[before])
+        siblings.insert(position, node)
+        
+        if parent < 0 or self.populated[parent]:
+            self._show(node, position)
+        elif self.shown[parent] and not self.tree.exists(self._placeholder(parent)):
+            self.tree.insert(str(parent), "end", iid=self._placeholder(parent))
+        
+        # A child matching its parent's state cannot change the parent
+        if parent >= 0 and not disabled and self.checked[node] != self.checked[parent]:
+            self._update_ancestors(node)
+            
+    def mark_loaded(self, key):
+        node = self.ids.get(key)
+        if node is None or self.loaded[node]:
+            return
+        self.loaded[node] = 1
+        self.loading.discard(node)
+        if self.shown[node] and self.tree.item(str(node), "open"):
+            self._populate(node)
+        elif not self.children[node] and self.tree.exists(self._placeholder(node)):
+            self.tree.delete(self._placeholder(node))
+
+    def is_loaded(self, key):
+        # The tree's own view: a directory's children have been added as
+        # nodes, whatever the snapshot behind it has scanned
+        node = self.ids.get(key)
+        return node is not None and self.loaded[node] == 1
+
+    def remove_item(self, key):
+        node = self.ids.pop(key, None)
+        if node is None:
+            return
+        parent = self.parents[node]
+        siblings = self.roots if parent < 0 else self.children[parent]
+        siblings.remove(node)
+        if self.shown[node] and self.tree.exists(str(node)):
+            self.tree.delete(str(node))
+        if parent >= 0 and not siblings and self.tree.exists(self._placeholder(parent)):
+            self.tree.delete(self._placeholder(parent))
+        self.keys[node] = None
+        self.checked[node] = 0
+        self.shown[node] = 0
+        if parent >= 0 and self.keys[parent] is not None:
+            self._update_ancestors(node)
+        
+    def _set(self, node, state):
+        self.checked[node] = state
+        if self.shown[node]:
+            self.tree.item(str(node), text=self._text(node))
+            
+    def _derive(self, node):
+        # State of a directory from its selectable children
+        states = {self.checked[child] for child in self.children[node] if not self.disabled[child]}
+        if not states:
+            return self.checked[node]
+        if len(states) == 1:
+            return states.pop()
+        return 2
+        
+    def _update_ancestors(self, node):
+        parent = self.parents[node]
+        while parent >= 0:
+            state = self._derive(parent)
+            if state == self.checked[parent]:
+                break
+            self._set(parent, state)
+            parent = self.parents[parent]
             
-    def on_checkbox_toggle(self, key):
-        if key in self.directories:
-            state = self.vars[key].get()
-            dir_prefix = key + os.sep
-            for file_key in self.vars:
-                if file_key.startswith(dir_prefix):
-                    # Set state for both files and subdirectories
-                    self.vars[file_key].set(state)
+    def toggle(self, node):
+        if self.disabled[node]:
+            return
+        state = 0 if self.checked[node] == 1 else 1
+        # One pass over the subtree through the children index
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if self.disabled[current]:
+                continue
+            self._set(current, state)
+            if self.is_dir[current]:
+                stack.extend(self.children[current])
+        self._update_ancestors(node)
+        
+    def _recompute_directories(self):
+        # Post-order pass so every directory sees its children's final state
+        order = []
+        stack = list(self.roots)
+        while stack:
+            node = stack.pop()
+            if self.is_dir[node]:
+                order.append(node)
+                stack.extend(self.children[node])
+        for node in reversed(order):
+            state = self._derive(node)
+            if state != self.checked[node]:
+                self._set(node, state)
+                    
+    def _redraw(self):
+        for node, shown in enumerate(self.shown):
+            if shown:
+                self.tree.item(str(node), text=self._text(node))
         
     def select_all(self):
-        for path, var in self.vars.items():
-          if path not in self.disabled_checkboxes:
-            var.set(True)
+        self.checked = bytearray(1 - disabled for disabled in self.disabled)
+        self._redraw()
             
     def deselect_all(self):
-        for path, var in self.vars.items():
-          if path not in self.disabled_checkboxes:
-            var.set(False)
+        self.checked = bytearray(len(self.keys))
+        self._redraw()
+        
+    def is_checked(self, key):
+        node = self.ids.get(key)
+        return node is not None and self.checked[node] == 1
+        
+    def selection_rules(self):
+        # The selection as (path, included) rules, one wherever a node differs
+        # from what it inherits. A partial directory is ruled the way most of
+        # its children go, so only the exceptions below it need rules of their
+        # own; fully checked or unchecked subtrees end the walk.
+        rules = []
+        stack = [(node, 0) for node in reversed(self.roots)]
+        while stack:
+            node, inherited = stack.pop()
+            if self.disabled[node]:
+                continue
+            state = self.checked[node]
+            if state == 2:
+                children = [child for child in self.children[node] if not self.disabled[child]]
+                state = 1 if 2 * sum(1 for child in children if self.checked[child]) > len(children) else 0
+                stack.extend((child, state) for child in reversed(children))
+            if state != inherited:
+                rules.append((self.keys[node], state == 1))
+        return rules
+        
+    def apply_rules(self, rules):
+        # Replaces the selection in one pass: each node takes the nearest rule
+        # on it or above it. Rules for paths not in the tree are ignored.
+        rules = dict(rules)
+        ruled = set()  # Directories with a rule somewhere below them
+        for path in rules:
+            path = os.path.dirname(path)
+            while path and path not in ruled:
+                ruled.add(path)
+                path = os.path.dirname(path)
+        keys, children, disabled = self.keys, self.children, self.disabled
+        checked = bytearray(len(keys))
+        stack = [(node, False) for node in self.roots]
+        while stack:
+            node, included = stack.pop()
+            key = keys[node]
+            included = rules.get(key, included)
+            if children[node] is None:
+                checked[node] = included and not disabled[node]
+            elif key in ruled:
+                stack.extend((child, included) for child in children[node])
+            elif included:
+                # Nothing below overrides this, so the whole subtree is in
+                subtree = [node]
+                while subtree:
+                    current = subtree.pop()
+                    checked[current] = not disabled[current]
+                    if children[current] is not None:
+                        subtree.extend(children[current])
+        self.checked = checked
+        self._recompute_directories()
+        self._redraw()
             
     def get_selected(self):
-        return [path for path, var in self.vars.items() if var.get()]
+        # Checked paths in display order
+        selected = []
+        stack = list(reversed(self.roots))
+        while stack:
+            node = stack.pop()
+            if self.checked[node] == 1:
+                selected.append(self.keys[node])
+            if self.is_dir[node]:
+                stack.extend(reversed(self.children[node]))
+        return selected
+
+class JobRunner:
+    # Runs one background job at a time. The job never touches Tk: it gets a
+    # cancel event, and its result or exception is handed to on_finish through
+    # call_in_ui, so on_finish runs on the Tk thread once the job really ends.
+    def __init__(self, call_in_ui):
+        self.call_in_ui = call_in_ui
+        self.thread = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, work, on_finish):
+        if self.running:
+            return False
+        cancel_event = self.cancel_event = threading.Event()
+
+        def run():
+            try:
+                result, error = work(cancel_event), None
+            except Exception as e:
+                result, error = None, e
+            self.call_in_ui(on_finish, result, error)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return True
+
+    def cancel(self):
+        self.cancel_event.set()
 
 class FileProcessorGUI:
     def __init__(self):
@@ -103,12 +396,31 @@ class FileProcessorGUI:
         # Variables
         self.folder_path = tk.StringVar()
         self.remove_comments_var = tk.BooleanVar(value=False)
-        self.default_ignores = {'.git', 'node_modules', '.next', '__pycache__', 'package-lock.json', '.ico', 'pastebin'}
+        self.default_ignores = set(DEFAULT_IGNORES)
         self.ignore_vars = {}
-        self.files_to_ignore = {"collation-engine.py", "combined_output.txt", "file_structure.txt"}
+        self.files_to_ignore = set(FILES_TO_IGNORE)
         
         self.observer = None
+        self.fs_handler = None
+        self.watches = {}  # Top-level directory -> its recursive watch
+        # Search index over the whole listing, built on first search
+        self.path_index = None
+        self.index_listing = None  # The full scan behind it, lent to the lazy listing
+        self.indexing = None  # Snapshot an index is being built for
+        self.search_matches = None
+        self.snapshot = None
+        self.ignore_matcher = None
+        self.watch_matcher = None  # What the watcher skips; see git_watch_matcher
+        self.relisting = False  # A git listing is being taken for watcher events
+        self.relist_pending = False
+        self.listing = None  # Token of the git listing being taken for the tree
+        self.listing_rules = None  # Selection to put back once it is shown
+        # Background threads never call into Tk; they queue callbacks that
+        # _drain_ui_queue runs on the main thread
+        self.ui_queue = queue.Queue()
+        self.jobs = JobRunner(self.call_in_ui)
         self.setup_gui()
+        self._drain_ui_queue()
         
     def setup_gui(self):
         main_frame = ttk.Frame(self.root, padding="10")
@@ -127,12 +439,38 @@ class FileProcessorGUI:
         ttk.Entry(folder_frame, textvariable=self.folder_path, width=50).pack(side="left", padx=5)
         ttk.Button(folder_frame, text="Browse", command=self.browse_folder).pack(side="left")
         
+        # List files from git instead of walking, optionally only those changed since a ref
+        self.use_git_var = tk.BooleanVar(value=False)
+        self.since_var = tk.StringVar()
+        git_frame = ttk.Frame(left_frame)
+        git_frame.pack(fill="x")
+        ttk.Checkbutton(git_frame, text="Use git index", variable=self.use_git_var, command=self.on_listing_changed).pack(side="left")
+        ttk.Label(git_frame, text="Changed since:").pack(side="left", padx=(10, 0))
+        ttk.Entry(git_frame, textvariable=self.since_var, width=20).pack(side="left", padx=5)
+        ttk.Button(git_frame, text="Apply", command=self.on_listing_changed).pack(side="left")
+        
         # File selection (now comes right after folder selection in left panel)
         file_frame = ttk.LabelFrame(left_frame, text="Select Files to Include", padding="5")
         file_frame.pack(fill="both", expand=True, pady=5)
         
+        # Filter the tree as you type: substring, glob (ignore-pattern syntax) or fuzzy
+        self.search_var = tk.StringVar()
+        self.search_mode_var = tk.StringVar(value="substring")
+        search_frame = ttk.Frame(file_frame)
+        search_frame.pack(fill="x")
+        ttk.Label(search_frame, text="Search:").pack(side="left")
+        ttk.Entry(search_frame, textvariable=self.search_var, width=30).pack(side="left", padx=5)
+        search_mode_box = ttk.Combobox(search_frame, textvariable=self.search_mode_var, values=PathIndex.MODES, state="readonly", width=9)
+        search_mode_box.pack(side="left")
+        search_mode_box.bind("<<ComboboxSelected>>", self.on_search_changed)
+        ttk.Button(search_frame, text="Select Matches", command=self.select_search_matches).pack(side="left", padx=5)
+        self.search_label = ttk.Label(search_frame, text="")
+        self.search_label.pack(side="left")
+        self.search_var.trace_add("write", self.on_search_changed)
+        
         # Add checkbox tree
         self.checkbox_tree = FileCheckboxTree(file_frame)
+        self.checkbox_tree.load_callback = self.load_directory
         self.checkbox_tree.pack(fill="both", expand=True, pady=5)
         
         # Selection buttons
@@ -141,6 +479,18 @@ class FileProcessorGUI:
         ttk.Button(select_frame, text="Select All", command=self.checkbox_tree.select_all).pack(side="left", padx=5)
         ttk.Button(select_frame, text="Deselect All", command=self.checkbox_tree.deselect_all).pack(side="left")
         
+        # Named selections kept between sessions
+        self.profiles = SelectionProfiles(os.path.join(self.script_dir, PROFILES_FILE_NAME))
+        self.selection_profile_var = tk.StringVar()
+        profile_frame = ttk.Frame(left_frame)
+        profile_frame.pack(fill="x")
+        ttk.Label(profile_frame, text="Selection profile:").pack(side="left")
+        self.profile_box = ttk.Combobox(profile_frame, textvariable=self.selection_profile_var, values=self.profiles.names(), width=20)
+        self.profile_box.pack(side="left", padx=5)
+        ttk.Button(profile_frame, text="Save", command=self.save_profile).pack(side="left")
+        ttk.Button(profile_frame, text="Load", command=self.load_profile).pack(side="left", padx=5)
+        ttk.Button(profile_frame, text="Delete", command=self.delete_profile).pack(side="left")
+        
         # Right panel
         right_frame = ttk.Frame(main_frame)
         right_frame.grid(row=0, column=1, sticky="nsew")
@@ -178,6 +528,11 @@ class FileProcessorGUI:
         ttk.Button(ignore_frame, text="Add Selected as Ignores", command=self.add_selected_as_ignores).grid(
             row=len(self.default_ignores)//2 + 4, column=0, columnspan=2, sticky="w", pady=2)
         
+        self.use_gitignore_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(ignore_frame, text="Respect .gitignore files", variable=self.use_gitignore_var,
+                        command=self.refresh_file_list).grid(
+            row=len(self.default_ignores)//2 + 5, column=0, columnspan=2, sticky="w", pady=2)
+        
         # Options
         options_frame = ttk.LabelFrame(right_frame, text="Options", padding="5")
         options_frame.pack(fill="x", pady=5)
@@ -187,6 +542,80 @@ class FileProcessorGUI:
         self.custom_save_location = tk.BooleanVar(value=False)
         ttk.Checkbutton(options_frame, text="Choose Custom Save Location", variable=self.custom_save_location).pack(anchor="w")
         
+        # Files above this size are listed but not included (0 = no limit)
+        self.size_limit_kb = tk.StringVar(value=str(DEFAULT_SIZE_LIMIT // 1024))
+        size_frame = ttk.Frame(options_frame)
+        size_frame.pack(anchor="w")
+        ttk.Label(size_frame, text="Max file size (KB, 0 = no limit):").pack(side="left")
+        ttk.Spinbox(size_frame, from_=0, to=10**7, increment=256, textvariable=self.size_limit_kb, width=8).pack(side="left", padx=5)
+        
+        # Per-file results cached between saves
+        self.cache_var = tk.BooleanVar(value=True)
+        cache_frame = ttk.Frame(options_frame)
+        cache_frame.pack(anchor="w")
+        ttk.Checkbutton(cache_frame, text="Cache Results", variable=self.cache_var).pack(side="left")
+        ttk.Button(cache_frame, text="Clear Cache", command=self.clear_result_cache).pack(side="left", padx=5)
+        
+        # Parallel collation over a process pool (0 workers = one per core)
+        self.parallel_var = tk.BooleanVar(value=False)
+        self.workers_var = tk.StringVar(value="0")
+        self.batch_size_var = tk.StringVar(value=str(DEFAULT_BATCH_SIZE))
+        ttk.Checkbutton(options_frame, text="Parallel Collation", variable=self.parallel_var).pack(anchor="w")
+        parallel_frame = ttk.Frame(options_frame)
+        parallel_frame.pack(anchor="w")
+        ttk.Label(parallel_frame, text="Workers:").pack(side="left")
+        ttk.Spinbox(parallel_frame, from_=0, to=256, textvariable=self.workers_var, width=4).pack(side="left", padx=5)
+        ttk.Label(parallel_frame, text="Batch size:").pack(side="left")
+        ttk.Spinbox(parallel_frame, from_=1, to=4096, textvariable=self.batch_size_var, width=6).pack(side="left", padx=5)
+        
+        # Files read ahead on threads, for slow and network drives (0 = off)
+        self.prefetch_var = tk.StringVar(value="0")
+        prefetch_frame = ttk.Frame(options_frame)
+        prefetch_frame.pack(anchor="w")
+        ttk.Label(prefetch_frame, text="Read ahead (files, 0 = off):").pack(side="left")
+        ttk.Spinbox(prefetch_frame, from_=0, to=1024, increment=8, textvariable=self.prefetch_var, width=6).pack(side="left", padx=5)
+        
+        # Per-stage timings in the log and a metrics JSON next to the outputs
+        self.metrics_var = tk.BooleanVar(value=False)
+        self.profile_var = tk.BooleanVar(value=False)
+        metrics_frame = ttk.Frame(options_frame)
+        metrics_frame.pack(anchor="w")
+        ttk.Checkbutton(metrics_frame, text="Collect Metrics", variable=self.metrics_var).pack(side="left")
+        ttk.Checkbutton(metrics_frame, text="Profile", variable=self.profile_var).pack(side="left", padx=5)
+        
+        # Binary and generated files are flagged in the tree; summarise, skip or read them
+        self.non_text_var = tk.StringVar(value="summary")
+        non_text_frame = ttk.Frame(options_frame)
+        non_text_frame.pack(anchor="w")
+        ttk.Label(non_text_frame, text="Binary/generated files:").pack(side="left")
+        non_text_box = ttk.Combobox(non_text_frame, textvariable=self.non_text_var, values=("summary", "skip", "include"), state="readonly", width=8)
+        non_text_box.pack(side="left", padx=5)
+        non_text_box.bind("<<ComboboxSelected>>", self.on_non_text_changed)
+        
+        # Flat text, or gzip/JSONL with an index for pulling out single files
+        self.output_format_var = tk.StringVar(value="txt")
+        format_frame = ttk.Frame(options_frame)
+        format_frame.pack(anchor="w")
+        ttk.Label(format_frame, text="Contents format:").pack(side="left")
+        ttk.Combobox(format_frame, textvariable=self.output_format_var, values=tuple(CONTENT_FILE_NAMES), state="readonly", width=7).pack(side="left", padx=5)
+        
+        # Rebuild a flat contents file from the last save, re-reading only changed files
+        self.incremental_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(options_frame, text="Incremental Save", variable=self.incremental_var).pack(anchor="w")
+        
+        # Later copies of byte-identical files become a reference to the first
+        self.dedup_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Deduplicate Identical Files", variable=self.dedup_var).pack(anchor="w")
+        
+        # Split the contents into numbered parts under a budget (0 = one file, txt only)
+        self.chunk_size_var = tk.StringVar(value="0")
+        self.chunk_unit_var = tk.StringVar(value="KB")
+        chunk_frame = ttk.Frame(options_frame)
+        chunk_frame.pack(anchor="w")
+        ttk.Label(chunk_frame, text="Split contents every (0 = off):").pack(side="left")
+        ttk.Spinbox(chunk_frame, from_=0, to=10**7, increment=64, textvariable=self.chunk_size_var, width=8).pack(side="left", padx=5)
+        ttk.Combobox(chunk_frame, textvariable=self.chunk_unit_var, values=("KB", "tokens"), state="readonly", width=7).pack(side="left")
+        
         # Replace the Generate buttons section with Save section
         save_frame = ttk.LabelFrame(right_frame, text="Save", padding="5")
         save_frame.pack(fill="x", pady=10)
@@ -201,7 +630,17 @@ class FileProcessorGUI:
         ttk.Checkbutton(save_frame, text="Line Counts", variable=self.save_line_counts).pack(anchor="w")
         
         # Add the Save button
-        ttk.Button(save_frame, text="Save", command=self.save_selected).pack(pady=10)
+        button_frame = ttk.Frame(save_frame)
+        button_frame.pack(pady=10)
+        self.save_button = ttk.Button(button_frame, text="Save", command=self.save_selected)
+        self.save_button.pack(side="left", padx=2)
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.jobs.cancel, state="disabled")
+        self.cancel_button.pack(side="left", padx=2)
+
+        self.progress_bar = ttk.Progressbar(save_frame, mode="determinate")
+        self.progress_bar.pack(fill="x")
+        self.progress_label = ttk.Label(save_frame, text="", width=40)
+        self.progress_label.pack(anchor="w")
 
         # Output log
         log_frame = ttk.LabelFrame(right_frame, text="Output Log", padding="5")
@@ -217,325 +656,586 @@ class FileProcessorGUI:
         if folder:
             self.folder_path.set(folder)
             self.stop_monitoring()
-            self.start_monitoring(folder)
+            # The ignore rules come with the listing, and decide what is watched
             self.refresh_file_list()
+            self.start_monitoring(folder)
             
-    def refresh_file_list(self):
+    def refresh_file_list(self, rules=None):
+        # rules: a selection to put back once the new listing is shown
         self.checkbox_tree.clear()
+        self.listing = None
         folder = self.folder_path.get()
         if not folder:
+            self.snapshot = None
             return
-            
-        ignore_patterns = self.get_ignore_patterns()
-        
-        def add_files(path, indent=0):
+        if self.use_git_var.get():
+            # git stats and sniffs every file it lists, so that runs off the
+            # UI thread and the tree fills in when it is done
+            self.snapshot = None
+            self.path_index = self.index_listing = None
+            self.list_from_git(folder, rules)
+            return
+        self.show_listing(self.build_snapshot(folder), rules)
+
+    def show_listing(self, snapshot, rules=None):
+        self.snapshot = snapshot
+        for path, error in snapshot.errors:
+            self.log_message(f"Error accessing {path}: {error}")
+
+        for entry, indent in snapshot.walk():
+            self._add_tree_item(entry, indent)
+        # The ignore rules may have changed what should be watched
+        self.sync_watches()
+        self.path_index = self.index_listing = None
+        if self.search_var.get().strip():
+            self.on_search_changed()
+        if rules is not None:
+            self.apply_selection_rules(rules)
+
+    def list_from_git(self, folder, rules):
+        # A newer refresh drops this listing; watcher events that come in
+        # meanwhile are caught up on by relisting once it is shown
+        self.ignore_matcher = self.watch_matcher = matcher = self.build_ignore_matcher()
+        watch_matcher = self.build_ignore_matcher(gitignore=True)
+        since = self.since_var.get().strip() or None
+        listing = self.listing = object()
+        self.listing_rules = rules
+
+        def list_files():
             try:
-                for item in sorted(os.listdir(path)):
-                    full_path = os.path.join(path, item)
-                    relative_path = os.path.relpath(full_path, folder)
-                    
-                    if any(pattern in relative_path for pattern in ignore_patterns):
-                        continue
-                        
-                    if os.path.isfile(full_path):
-                        disabled = os.path.basename(full_path) in self.files_to_ignore
-                        display_name = os.path.basename(relative_path)
-                        self.checkbox_tree.add_item(relative_path, display_name, indent, disabled)
-                    else:
-                        self.checkbox_tree.add_item(relative_path, f"[{item}]", indent, is_directory=True)
-                        add_files(full_path, indent + 1)
-            except Exception as e:
-                self.log_message(f"Error accessing {path}: {str(e)}")
-                
-        add_files(folder)
-        
-    def log_message(self, message):
-        self.log.insert(tk.END, f"{message}\n")
-        self.log.see(tk.END)
-        
-    def get_ignore_patterns(self):
-        patterns = {pattern for pattern, var in self.ignore_vars.items() if var.get()}
-        patterns.update(self.custom_patterns)
-        return patterns
-        
-    def generate_tree(self, dir_path, output_file, ignore_patterns):
-        with open(output_file, 'w', encoding='utf-8') as f:
-            def write_tree(path, prefix=""):
-                if any(pattern in path for pattern in ignore_patterns):
-                    return
-                    
-                f.write(f"{prefix}├── {os.path.basename(path)}\n")
-                if os.path.isdir(path):
-                    for item in sorted(os.listdir(path)):
-                        write_tree(os.path.join(path, item), prefix + "│   ")
-                        
-            write_tree(dir_path)
-
-    def remove_comments(self, content, file_extension):
-        patterns = {
-            '.py': {
-                'single': r'#.*$',
-                'multi': r'"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'',
-                'inline_multi': True
-            },
-            '.js': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True
-            },
-            '.ts': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True,
-                'jsdoc': r'/\*\*[\s\S]*?\*/'
-            },
-            '.tsx': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True,
-                'jsdoc': r'/\*\*[\s\S]*?\*/'
-            },
-            '.jsx': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True,
-                'jsdoc': r'/\*\*[\s\S]*?\*/'
-            },
-            '.java': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True
-            },
-            '.cpp': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True
-            },
-            '.cs': {
-                'single': r'//.*$',
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True
-            },
-            '.html': {
-                'single': None,
-                'multi': r'<!--[\s\S]*?-->',
-                'inline_multi': True
-            },
-            '.css': {
-                'single': None,
-                'multi': r'/\*[\s\S]*?\*/',
-                'inline_multi': True
-            }
-        }
-        
-        ext = os.path.splitext(file_extension.lower())[1]
-        pattern = patterns.get(ext, patterns['.ts'])
-        
-        if pattern.get('jsdoc'):
-            content = re.sub(pattern['jsdoc'], '', content)
-            
-        if pattern['multi']:
-            content = re.sub(pattern['multi'], '', content)
-        
-        if pattern['single']:
-            lines = content.split('\n')
-            lines = [re.sub(pattern['single'], '', line) for line in lines]
-            content = '\n'.join(lines)
-        
-        lines = content.split('\n')
-        lines = [line.rstrip() for line in lines if line.strip()]
-        return '\n'.join(lines)
-
-    def count_non_comment_lines(self, content, file_extension):
-        patterns = {
-            '.py': {
-                'single': r'#.*$',
-                'multi_start': r'("""|\'\'\').*$',
-                'multi_end': r'^.*?("""|\'\'\').*$',
-                'inline_multi': True
-            },
-            '.js': {
-                'single': r'//.*$',
-                'multi_start': r'/\*.*$',
-                'multi_end': r'^.*?\*/.*$',
-                'inline_multi': True
-            },
-            '.ts': {
-                'single': r'//.*$',
-                'multi_start': r'/\*.*$',
-                'multi_end': r'^.*?\*/.*$',
-                'inline_multi': True
-            },
-            '.tsx': {
-                'single': r'//.*$',
-                'multi_start': r'/\*.*$',
-                'multi_end': r'^.*?\*/.*$',
-                'inline_multi': True
-            },
-            '.jsx': {
-                'single': r'//.*$',
-                'multi_start': r'/\*.*$',
-                'multi_end': r'^.*?\*/.*$',
-                'inline_multi': True
-            },
-            '.html': {
-                'single': None,
-                'multi_start': r'<!--.*$',
-                'multi_end': r'^.*?-->.*$',
-                'inline_multi': True
-            },
-            '.css': {
-                'single': None,
-                'multi_start': r'/\*.*$',
-                'multi_end': r'^.*?\*/.*$',
-                'inline_multi': True
-            }
-        }
-
-        ext = os.path.splitext(file_extension.lower())[1]
-        pattern = patterns.get(ext, patterns['.js'])
-
-        lines = content.split('\n')
-        non_comment_lines = 0
-        in_multi_comment = False
-
-        for line in lines:
-            line = line.strip()
-            
-            if not line:
-                continue
+                snapshot = DirectorySnapshot.from_git(folder, matcher, since, classify=True)
+                self.git_watch_matcher(watch_matcher, snapshot)
+                error = None
+            except (GitError, OSError) as e:
+                snapshot, error = None, e
+            self.call_in_ui(self._git_files_listed, listing, folder, snapshot, watch_matcher, error)
 
-            if pattern['multi_start'] and re.search(pattern['multi_start'], line):
-                in_multi_comment = True
-                if pattern['multi_end'] and re.search(pattern['multi_end'], line):
-                    in_multi_comment = False
-                continue
+        threading.Thread(target=list_files, daemon=True).start()
 
-            if in_multi_comment:
-                if pattern['multi_end'] and re.search(pattern['multi_end'], line):
-                    in_multi_comment = False
-                continue
+    def _git_files_listed(self, listing, folder, snapshot, watch_matcher, error):
+        if listing is not self.listing:
+            return
+        rules = self.listing_rules
+        self.listing = self.listing_rules = None
+        if snapshot is None:
+            self.log_message(f"Cannot list files from git, walking the folder instead: {str(error)}")
+            snapshot = DirectorySnapshot.scan(folder, self.ignore_matcher, lazy=True, classify=True)
+        else:
+            self.watch_matcher = watch_matcher
+        self.show_listing(snapshot, rules)
+        if self.relist_pending and self.use_git_var.get():
+            self.relist_from_git()
 
-            if pattern['single'] and re.match(pattern['single'], line.lstrip()):
-                continue
+    def build_snapshot(self, folder):
+        # From git when asked for (the whole listing is known up front);
+        # otherwise only the top level is scanned and directories load when expanded
+        self.ignore_matcher = self.watch_matcher = self.build_ignore_matcher()
+        if self.use_git_var.get():
+            since = self.since_var.get().strip() or None
+            try:
+                snapshot = DirectorySnapshot.from_git(folder, self.ignore_matcher, since, classify=True)
+            except GitError as e:
+                self.log_message(f"Cannot list files from git, walking the folder instead: {str(e)}")
+            else:
+                self.watch_matcher = self.git_watch_matcher(self.build_ignore_matcher(gitignore=True), snapshot)
+                return snapshot
+        return DirectorySnapshot.scan(folder, self.ignore_matcher, lazy=True, classify=True)
 
-            non_comment_lines += 1
+    def on_listing_changed(self):
+        self.refresh_keeping_selection()
 
-        return non_comment_lines
+    def refresh_keeping_selection(self):
+        if self.listing is not None:
+            # Nothing is shown yet; keep what the listing in flight puts back
+            self.refresh_file_list(self.listing_rules)
+        else:
+            self.refresh_file_list(self.checkbox_tree.selection_rules())
 
-    def combine_files(self, source_dir, output_file):
-        selected_files = self.checkbox_tree.get_selected()
-        line_counts = {}
+    def apply_selection_rules(self, rules):
+        # Directories that hold a rule are scanned first so the rule has a
+        # node to land on
+        self.load_ancestors(path for path, _ in rules)
+        self.checkbox_tree.apply_rules(rules)
+
+    def load_ancestors(self, paths):
+        # Load any directory above these paths that has no rows yet; paths
+        # that are no longer there are skipped. Directories the search
+        # index's scan has seen are taken from it, so only ones nothing has
+        # scanned yet are listed here.
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        listing = self.index_listing
+        for path in paths:
+            directory = ""
+            for name in path.split(os.sep)[:-1]:
+                directory = os.path.join(directory, name) if directory else name
+                entry = snapshot.get(directory)
+                if entry is None or not entry.is_dir:
+                    break
+                if not self.checkbox_tree.is_loaded(directory):
+                    # A save may have scanned it already without adding rows
+                    if not entry.loaded and listing is not None:
+                        snapshot.adopt(directory, listing)
+                    children = entry.children if entry.loaded else snapshot.list_dir(directory)
+                    self._attach_directory(snapshot, directory, children)
+
+    def on_search_changed(self, *args):
+        query = self.search_var.get().strip()
+        if not query:
+            if self.search_matches is not None:
+                self.search_matches = None
+                self.checkbox_tree.set_filter(None)
+            self.search_label.config(text="")
+            return
+        if self.path_index is None:
+            self.search_label.config(text="Indexing…")
+            self.build_path_index()
+            return
+        matches = [self.path_index.paths[i] for i in self.path_index.search(query, self.search_mode_var.get())]
+        shown = matches[:MAX_SEARCH_ROWS]
+        self.load_ancestors(shown)
+        self.checkbox_tree.set_filter(shown)
+        self.search_matches = matches
+        if len(matches) > len(shown):
+            self.search_label.config(text=f"{len(matches)} matches, first {len(shown)} shown")
+        else:
+            self.search_label.config(text=f"{len(matches)} matches")
 
-        with open(output_file, 'w', encoding='utf-8') as f:
-            if self.remove_comments_var.get():
-                f.write("Comments have been removed from the source files\n")
+    def build_path_index(self):
+        # A lazy listing only knows the directories opened so far, so the
+        # index comes from a full scan of its own, on a background thread.
+        # The scan sniffs files like the listing does, and is kept so the
+        # directories it saw need no scan when search results open them.
+        snapshot = self.snapshot
+        if snapshot is None or self.indexing is snapshot:
+            return
+        self.indexing = snapshot
+        matcher = None if self.use_git_var.get() else self.build_ignore_matcher()
 
-            selected_files.sort(key=lambda x: x.count(os.sep))
-            current_dir = None
+        def build():
+            try:
+                listing = snapshot
+                if matcher is not None:
+                    listing = DirectorySnapshot.scan(snapshot.root, matcher, classify=snapshot.classify)
+                index = PathIndex.from_snapshot(listing)
+            except Exception as e:
+                self.log_threadsafe(f"Error indexing {snapshot.root}: {str(e)}")
+                listing = index = None
+            self.call_in_ui(self._path_index_ready, snapshot, index, listing)
 
-            for relative_path in selected_files:
-                # Skip directory entries that are shown in square brackets in the UI
-                if relative_path.startswith('[') and relative_path.endswith(']'):
-                    continue
+        threading.Thread(target=build, daemon=True).start()
 
-                file_path = os.path.join(source_dir, relative_path)
-                
-                # Skip if it's a directory or ignored file
-                if os.path.isdir(file_path) or os.path.basename(file_path) in self.files_to_ignore:
-                    continue
+    def _path_index_ready(self, snapshot, index, listing):
+        if self.indexing is snapshot:
+            self.indexing = None
+        if snapshot is not self.snapshot or index is None:
+            return
+        self.path_index = index
+        self.index_listing = listing if listing is not snapshot else None
+        self.on_search_changed()
+
+    def select_search_matches(self):
+        # Every match, not just the rows shown, added to the selection in one pass
+        if not self.search_matches:
+            return
+        rules = self.checkbox_tree.selection_rules() + [(path, True) for path in self.search_matches]
+        self.apply_selection_rules(rules)
+        self.log_message(f"Selected {len(self.search_matches)} matching paths")
 
-                dir_path = os.path.dirname(relative_path)
-                if dir_path != current_dir:
-                    if dir_path:
-                        f.write(f"\n{'='*11}\nDirectory: {dir_path}\n{'='*11}\n\n")
-                    current_dir = dir_path
+    def call_in_ui(self, func, *args):
+        # Safe from any thread
+        self.ui_queue.put((func, args))
 
-                f.write(f"File: {relative_path}\n{'-'*20}\n\n")
+    def log_threadsafe(self, message):
+        self.call_in_ui(self.log_message, message)
 
+    def _drain_ui_queue(self):
+        try:
+            while True:
+                func, args = self.ui_queue.get_nowait()
                 try:
-                    if os.path.getsize(file_path) > 1024 * 1024:  # Skip files larger than 1MB
-                        f.write("File too large to include in combined output\n")
-                        line_counts[relative_path] = 0
-                    else:
-                        try:
-                            with open(file_path, 'r', encoding='utf-8') as infile:
-                                content = infile.read()
-                                line_counts[relative_path] = self.count_non_comment_lines(content, os.path.splitext(file_path)[1])
-                                if self.remove_comments_var.get():
-                                    content = self.remove_comments(content, os.path.splitext(file_path)[1])
-                                f.write(content)
-                        except UnicodeDecodeError:
-                            with open(file_path, 'r', encoding='latin-1') as infile:
-                                content = infile.read()
-                                line_counts[relative_path] = self.count_non_comment_lines(content, os.path.splitext(file_path)[1])
-                                if self.remove_comments_var.get():
-                                    content = self.remove_comments(content, os.path.splitext(file_path)[1])
-                                f.write(content)
+                    func(*args)
                 except Exception as e:
-                    f.write(f"Error reading file: {str(e)}\n")
-                    line_counts[relative_path] = 0
+                    self.log_message(f"Error: {str(e)}")
+        except queue.Empty:
+            pass
+        self.root.after(50, self._drain_ui_queue)
+
+    def on_non_text_changed(self, event=None):
+        # Redraw so binary/generated files become (un)selectable; keep the selection
+        self.refresh_keeping_selection()
+
+    def load_directory(self, key):
+        # Scan one directory on a background thread; the listing is attached
+        # on the main thread by _attach_directory
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        entry = snapshot.get(key)
+        if entry is not None and not entry.loaded and self.index_listing is not None:
+            snapshot.adopt(key, self.index_listing)
+        if entry is not None and entry.loaded:
+            # Scanned already, by a save or the search index's scan; only the
+            # rows are missing. Queued so the Treeview has opened the row by then.
+            self.call_in_ui(self._attach_directory, snapshot, key, entry.children)
+            return
+        threading.Thread(target=lambda: self.call_in_ui(self._attach_directory, snapshot, key,
+                                                        snapshot.list_dir(key)),
+                         daemon=True).start()
+
+    def _attach_directory(self, snapshot, key, children):
+        if snapshot is not self.snapshot:
+            return
+        inherit = self.checkbox_tree.is_checked(key)
+        indent = key.count(os.sep) + 1
+        for entry in snapshot.attach(key, children):
+            # Only this level gets rows; loaded subdirectories add theirs when opened
+            self._add_tree_item(entry, indent, checked=inherit, loaded=False)
+        self.checkbox_tree.mark_loaded(key)
+        for path, error in snapshot.errors:
+            self.log_message(f"Error accessing {path}: {error}")
+        del snapshot.errors[:]
+
+    def _add_tree_item(self, entry, indent, before=None, checked=False, loaded=True):
+        # loaded=False leaves a directory's children out of the tree until it
+        # is opened, even if the snapshot has them
+        if entry.is_dir:
+            self.checkbox_tree.add_item(entry.path, f"[{entry.name}]", indent, is_directory=True,
+                                        before=before, checked=checked, loaded=loaded and entry.loaded)
+        else:
+            disabled = entry.name in self.files_to_ignore
+            text = entry.name
+            if entry.sniffed is not None and entry.sniffed.kind in NON_TEXT_KINDS:
+                # Not selectable unless they are going to be read anyway
+                text = f"{entry.name}  ({entry.sniffed.kind}: {entry.sniffed.detail})"
+                disabled = disabled or self.non_text_var.get() != "include"
+            self.checkbox_tree.add_item(entry.path, text, indent, disabled,
+                                        before=before, checked=checked and not disabled)
+
+    def apply_fs_events(self, events):
+        # Patch the snapshot and the tree for just the paths that changed,
+        # leaving every other checkbox (and its selection) untouched
+        snapshot = self.snapshot
+        if snapshot is None:
+            if self.listing is not None:
+                # The git listing in flight may have missed these
+                self.relist_pending = True
+            else:
+                self.refresh_file_list()
+            return
+        if events is None:
+            # Too many changes to patch one by one
+            self.refresh_keeping_selection()
+            return
+        if any(is_directory and event_type != 'modified' and snapshot.root in (os.path.dirname(src_path),
+                                                                                 os.path.dirname(dest_path))
+               for event_type, src_path, dest_path, is_directory in events):
+            # A top-level directory came or went
+            self.sync_watches()
+        if self.use_git_var.get():
+            # git decides what is listed. Edits are applied in place; paths
+            # coming or going mean asking git again, off the UI thread, and so
+            # does any edit when listing changes since a ref, as it can bring
+            # a file into the listing or take it out, and any .gitignore edit.
+            # Changes inside .git alone are skipped: git itself writes there.
+            git_dir = os.sep + '.git' + os.sep
+            since = self.since_var.get().strip()
+            relist = False
+            for event_type, src_path, dest_path, is_directory in events:
+                if all(git_dir in path + os.sep for path in (src_path, dest_path) if path):
+                    continue
+                if (event_type != 'modified' or (since and not is_directory)
+                        or os.path.basename(src_path) == '.gitignore'):
+                    relist = True
+                elif not is_directory:
+                    snapshot.update(os.path.relpath(src_path, snapshot.root))
+            if relist:
+                self.relist_from_git()
+            return
 
-                f.write("\n\n")
+        matcher = self.ignore_matcher
 
-        return line_counts
+        def relative(path, is_directory):
+            relative_path = os.path.relpath(path, snapshot.root)
+            if relative_path == os.curdir or relative_path.startswith(os.pardir):
+                return None
+            if matcher is not None and matcher.is_path_ignored(relative_path, is_directory):
+                return None
+            return relative_path
 
-    def generate_line_counts_file(self, line_counts):
-        total_lines = sum(line_counts.values())
-        counts_file = os.path.join(self.script_dir, 'line_counts.txt')
-        with open(counts_file, 'w', encoding='utf-8') as f:
-            f.write(f"Total lines of code: {total_lines}\n\n")
-            f.write("Line counts per file:\n")
-            for file_path, count in line_counts.items():
-                f.write(f"{file_path}: {count}\n")
-        self.log_message(f"Generated line counts file: {counts_file}")
+        def remove(relative_path):
+            selected = set()
+            for entry in snapshot.remove(relative_path):
+                if self.checkbox_tree.is_checked(entry.path):
+                    selected.add(entry.path)
+                self.checkbox_tree.remove_item(entry.path)
+            return selected
 
-    def generate(self, mode='both'):
+        def add(relative_path, selected=()):
+            added = snapshot.add(relative_path)
+            if not added:
+                return
+            parent = os.path.dirname(added[0].path)
+            if parent and not self.checkbox_tree.is_loaded(parent):
+                return  # Picked up from the snapshot when its directory is opened
+            following = snapshot.next_after(added[0])
+            before = following.path if following is not None else None
+            inherit = self.checkbox_tree.is_checked(parent)
+            for entry in added:
+                indent = entry.path.count(os.sep)
+                self._add_tree_item(entry, indent, before, inherit or entry.path in selected)
+
+        if matcher is not None and matcher.gitignore and any(
+                os.path.basename(event[1]) == '.gitignore' or os.path.basename(event[2]) == '.gitignore'
+                for event in events):
+            # Ignore rules changed; rescan but keep what was selected
+            self.refresh_keeping_selection()
+            return
+
+        for event_type, src_path, dest_path, is_directory in events:
+            src = relative(src_path, is_directory)
+            if event_type == 'created' and src:
+                add(src)
+            elif event_type == 'deleted' and src:
+                remove(src)
+            elif event_type == 'modified' and src:
+                snapshot.update(src)
+            elif event_type == 'moved':
+                selected = remove(src) if src else set()
+                dest = relative(dest_path, is_directory)
+                if dest:
+                    # Carry the selection over to the renamed paths
+                    renamed = {dest + path[len(src):] for path in selected}
+                    add(dest, renamed)
+
+        if any(event_type != 'modified' for event_type, _, _, _ in events):
+            # Paths came or went; the search index is rebuilt when next used
+            self.path_index = self.index_listing = None
+            if self.search_var.get().strip():
+                self.on_search_changed()
+
+    def relist_from_git(self):
+        # Lists the files from git again on a background thread, then patches
+        # the tree with what came and went. Events arriving meanwhile ask for
+        # one more run once this one is in.
+        if self.relisting:
+            self.relist_pending = True
+            return
+        snapshot = self.snapshot
+        matcher = self.build_ignore_matcher()
+        watch_matcher = self.build_ignore_matcher(gitignore=True)
+        since = self.since_var.get().strip() or None
+        self.relisting = True
+        self.relist_pending = False
+
+        def relist():
+            added = removed = ()
+            try:
+                listing = DirectorySnapshot.from_git(snapshot.root, matcher, since, classify=True)
+                self.git_watch_matcher(watch_matcher, listing)
+            except (GitError, OSError) as e:
+                self.log_threadsafe(f"Cannot list files from git: {str(e)}")
+                listing = None
+            if listing is not None:
+                known = set(snapshot.entries)
+                added = [entry for entry, _ in listing.walk() if entry.path not in known]
+                # Deepest first, so nothing is removed before what is below it
+                removed = sorted(known.difference(listing.entries), key=lambda path: -path.count(os.sep))
+            self.call_in_ui(self._git_listing_ready, snapshot, listing, watch_matcher, added, removed)
+
+        threading.Thread(target=relist, daemon=True).start()
+
+    def _git_listing_ready(self, snapshot, listing, watch_matcher, added, removed):
+        self.relisting = False
+        # Dropped if the listing was rebuilt or git mode left in the meantime
+        if listing is not None and snapshot is self.snapshot and self.use_git_var.get():
+            self.snapshot = listing
+            # A .gitignore may have changed what should be watched
+            self.watch_matcher = watch_matcher
+            self.sync_watches()
+            for path in removed:
+                self.checkbox_tree.remove_item(path)
+            for entry in added:
+                # Placed before the next entry the tree already has
+                following = listing.next_after(entry)
+                while following is not None and snapshot.get(following.path) is None:
+                    following = listing.next_after(following)
+                self._add_tree_item(entry, entry.path.count(os.sep), following.path if following else None,
+                                    self.checkbox_tree.is_checked(os.path.dirname(entry.path)))
+            if added or removed:
+                self.path_index = self.index_listing = None
+                if self.search_var.get().strip():
+                    self.on_search_changed()
+        if self.relist_pending and self.snapshot is not None and self.use_git_var.get():
+            self.relist_from_git()
+
+    def log_message(self, message):
+        self.log.insert(tk.END, f"{message}\n")
+        self.log.see(tk.END)
+        
+    def build_ignore_matcher(self, gitignore=None):
+        # Built once per refresh; custom patterns win over the repo's .gitignore.
+        # A git listing has had .gitignore applied already.
+        defaults = sorted(pattern for pattern, var in self.ignore_vars.items() if var.get())
+        if gitignore is None:
+            gitignore = self.use_gitignore_var.get() and not self.use_git_var.get()
+        return IgnoreMatcher(defaults, self.custom_patterns, gitignore=gitignore)
+
+    @staticmethod
+    def git_watch_matcher(matcher, listing):
+        # git leaves ignored files out of its listing, so its matcher has no
+        # .gitignore rules, but the watcher still has to skip those paths:
+        # every file a build writes to an ignored dist/ would otherwise ask
+        # git to list everything again. matcher (built with gitignore=True)
+        # takes the rules of the .gitignore files in the listing. Safe off
+        # the main thread.
+        for entry in listing.entries.values():
+            if entry.name == '.gitignore' and not entry.is_dir:
+                matcher.add_gitignore(os.path.join(listing.root, entry.path), os.path.dirname(entry.path))
+        return matcher
+        
+    def clear_result_cache(self):
+        try:
+            with ResultCache(os.path.join(self.script_dir, CACHE_FILE_NAME)) as cache:
+                cache.clear()
+            self.log_message("Cleared the result cache")
+        except sqlite3.Error as e:
+            self.log_message(f"Error clearing the result cache: {str(e)}")
+
+    def get_size_limit(self):
+        try:
+            return max(0, int(self.size_limit_kb.get())) * 1024
+        except ValueError:
+            return DEFAULT_SIZE_LIMIT
+
+    def get_parallel_settings(self):
+        # (workers, batch_size); workers of None lets the pool use every core
+        try:
+            workers = max(0, int(self.workers_var.get())) or None
+        except ValueError:
+            workers = None
+        try:
+            batch_size = max(1, int(self.batch_size_var.get()))
+        except ValueError:
+            batch_size = DEFAULT_BATCH_SIZE
+        return workers, batch_size
+
+    def get_prefetch(self):
+        try:
+            return max(0, int(self.prefetch_var.get()))
+        except ValueError:
+            return 0
+
+    def get_chunk_budget(self):
+        # (chunk_bytes, chunk_tokens); both 0 writes a single content file
+        try:
+            size = max(0, int(self.chunk_size_var.get()))
+        except ValueError:
+            size = 0
+        if self.chunk_unit_var.get() == "tokens":
+            return 0, size
+        return size * 1024, 0
+
+    def get_collation_options(self):
+        # Read from the Tk variables on the main thread, before the job starts
+        workers, batch_size = self.get_parallel_settings()
+        chunk_bytes, chunk_tokens = self.get_chunk_budget()
+        return CollationOptions(
+            remove_comments=self.remove_comments_var.get(),
+            size_limit=self.get_size_limit(),
+            parallel=self.parallel_var.get(),
+            workers=workers,
+            batch_size=batch_size,
+            cache_path=os.path.join(self.script_dir, CACHE_FILE_NAME) if self.cache_var.get() else None,
+            files_to_ignore=self.files_to_ignore,
+            chunk_bytes=chunk_bytes,
+            chunk_tokens=chunk_tokens,
+            output_format=self.output_format_var.get(),
+            non_text=self.non_text_var.get(),
+            incremental=self.incremental_var.get(),
+            dedup=self.dedup_var.get(),
+            prefetch=self.get_prefetch(),
+        )
+
+    def get_save_location(self, default_name):
+        # Dialogs only run on the main thread, before the job starts
+        if self.custom_save_location.get():
+            extension = os.path.splitext(default_name)[1]
+            label = "Text files" if extension == ".txt" else f"{extension[1:].upper()} files"
+            return filedialog.asksaveasfilename(
+                defaultextension=extension,
+                initialfile=default_name,
+                filetypes=[(label, f"*{extension}"), ("All files", "*.*")]
+            )
+        return os.path.join(self.script_dir, default_name)
+
+    def generate(self, structure=False, content=False, counts=False, on_done=None):
+        # Starts the save job and returns True; on_done runs on the main
+        # thread once it has finished, failed or been cancelled
         folder = self.folder_path.get()
         if not folder:
             self.log_message("Please select a folder first!")
-            return
+            return False
+        if self.jobs.running:
+            self.log_message("A save is already running")
+            return False
 
-        ignore_patterns = self.get_ignore_patterns()
+        if self.listing is not None:
+            self.log_message("Still listing files from git")
+            return False
 
-        def get_save_location(default_name):
-            if self.custom_save_location.get():
-                return filedialog.asksaveasfilename(
-                    defaultextension=".txt",
-                    initialfile=default_name,
-                    filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
-                )
-            return os.path.join(self.script_dir, default_name)
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.root != folder:
+            snapshot = self.snapshot = self.build_snapshot(folder)
+        selected_files = self.checkbox_tree.get_selected()
+        options = self.get_collation_options()
 
-        def process():
-            try:
-                if mode == 'counts':
-                    content_file = os.path.join(self.script_dir, 'combined_output_temp.txt')
-                    line_counts = self.combine_files(folder, content_file)
-                    counts_file = get_save_location('line_counts.txt')
-                    if counts_file:
-                        self.generate_line_counts_file(line_counts)
-                    if os.path.exists(content_file):
-                        os.remove(content_file)
-                else:
-                    if mode in ['both', 'structure']:
-                        structure_file = get_save_location('file_structure.txt')
-                        if structure_file:
-                            self.generate_tree(folder, structure_file, ignore_patterns)
-                            self.log_message(f"Generated structure file: {structure_file}")
-
-                    if mode in ['both', 'content']:
-                        content_file = get_save_location('combined_output.txt')
-                        if content_file:
-                            line_counts = self.combine_files(folder, content_file)
-                            self.log_message(f"Generated content file: {content_file}")
-                            counts_file = get_save_location('line_counts.txt')
-                            if counts_file:
-                                self.generate_line_counts_file(line_counts)
-            except Exception as e:
-                self.log_message(f"Error: {str(e)}")
+        structure_file = self.get_save_location('file_structure.txt') if structure else None
+        content_file = self.get_save_location(CONTENT_FILE_NAMES[options.output_format]) if content else None
+        counts_file = self.get_save_location('line_counts.txt') if counts else None
+        if not (structure_file or content_file or counts_file):
+            return False
 
-        threading.Thread(target=process, daemon=True).start()
+        metrics = None
+        rescan = None
+        if self.metrics_var.get() or self.profile_var.get():
+            metrics = Instrumentation(profile=self.profile_var.get())
+            # The tree's listing was scanned a directory at a time as it was
+            # opened, so the job takes it again to time walk and filter.
+            # Files are sniffed as they are read, as for a CLI run.
+            matcher = self.build_ignore_matcher()
+            if self.use_git_var.get():
+                rescan = partial(DirectorySnapshot.from_git, folder, since=self.since_var.get().strip() or None)
+            else:
+                rescan = partial(DirectorySnapshot.scan, folder)
+
+        def work(cancel_event):
+            listing = snapshot if rescan is None else metrics.timed_listing(matcher, rescan)
+            return collate(listing, selected_files, structure_file, content_file, counts_file, options,
+                           self.log_threadsafe, lambda update: self.call_in_ui(self.show_progress, update),
+                           cancel_event, metrics)
+
+        def finished(result, error):
+            self.save_button.configure(state="normal")
+            self.cancel_button.configure(state="disabled")
+            self.progress_label.configure(text="")
+            self.progress_bar.configure(value=0)
+            if isinstance(error, CollationCancelled):
+                self.log_message("Save cancelled")
+            elif error is not None:
+                self.log_message(f"Error: {str(error)}")
+            if on_done is not None:
+                on_done()
+
+        self.save_button.configure(state="disabled")
+        self.cancel_button.configure(state="normal")
+        self.progress_label.configure(text="Starting…")
+        return self.jobs.start(work, finished)
+
+    def show_progress(self, update):
+        self.progress_bar.configure(maximum=max(1, update.files_total), value=update.files_done)
+        self.progress_label.configure(text=f"{update.describe()}\n{os.path.basename(update.current)}")
 
     def add_custom_ignore(self):
         pattern = self.custom_ignore.get().strip()
@@ -555,10 +1255,16 @@ class FileProcessorGUI:
 
     def add_selected_as_ignores(self):
         selected = self.checkbox_tree.get_selected()
+        selected_set = set(selected)
         for path in selected:
-            if path not in self.custom_patterns:
-                self.custom_patterns.append(path)
-                self.custom_listbox.insert(tk.END, path)
+            # A selected directory already covers everything below it
+            if os.path.dirname(path) in selected_set:
+                continue
+            entry = self.snapshot.get(path) if self.snapshot else None
+            pattern = '/' + path.replace(os.sep, '/') + ('/' if entry is not None and entry.is_dir else '')
+            if pattern not in self.custom_patterns:
+                self.custom_patterns.append(pattern)
+                self.custom_listbox.insert(tk.END, pattern)
         self.checkbox_tree.deselect_all()
         self.refresh_file_list()
 
@@ -568,9 +1274,13 @@ class FileProcessorGUI:
         self.refresh_file_list()
 
     def start_monitoring(self, path):
+        # Imported here so the engine and the GUI start without watchdog loaded
+        from watchdog.observers import Observer
         self.observer = Observer()
-        handler = FileSystemHandler(self.refresh_file_list)
-        self.observer.schedule(handler, path, recursive=True)
+        self.fs_handler = FileSystemHandler(lambda events: self.call_in_ui(self.apply_fs_events, events),
+                                            path, self.is_watched_path_ignored)
+        self.observer.schedule(self.fs_handler, path, recursive=False)
+        self.sync_watches()
         self.observer.start()
     
     def stop_monitoring(self):
@@ -578,6 +1288,49 @@ class FileProcessorGUI:
             self.observer.stop()
             self.observer.join()
             self.observer = None
+            self.fs_handler.cancel()
+            self.fs_handler = None
+            self.watches = {}
+
+    def sync_watches(self):
+        # The folder itself is watched on its own and each top-level directory
+        # recursively, leaving out ignored ones (.git, node_modules/, ...) so
+        # their churn never reaches watchdog. Ignored paths further down are
+        # dropped by the handler instead. Whatever the listing holds is
+        # watched: git keeps tracked files that a .gitignore also covers.
+        if self.observer is None:
+            return
+        root = self.fs_handler.root
+        matcher = self.watch_matcher
+        snapshot = self.snapshot
+        wanted = set()
+        try:
+            with os.scandir(root) as it:
+                for item in it:
+                    if item.is_dir(follow_symlinks=False) and not (
+                            matcher is not None and matcher.is_ignored(item.name, True)
+                            and (snapshot is None or snapshot.get(item.name) is None)):
+                        wanted.add(item.path)
+        except OSError as e:
+            self.log_message(f"Error watching {root}: {str(e)}")
+        for path in set(self.watches) - wanted:
+            try:
+                self.observer.unschedule(self.watches.pop(path))
+            except KeyError:
+                pass  # Gone with its directory
+        for path in wanted - set(self.watches):
+            try:
+                self.watches[path] = self.observer.schedule(self.fs_handler, path, recursive=True)
+            except OSError:
+                pass  # Removed since the scan
+
+    def is_watched_path_ignored(self, relative_path, is_directory):
+        # Runs on the watchdog thread, against whichever matcher and listing
+        # are current; listed paths are never ignored, as in sync_watches
+        matcher = self.watch_matcher
+        snapshot = self.snapshot
+        return (matcher is not None and matcher.is_path_ignored(relative_path, is_directory)
+                and (snapshot is None or snapshot.get(relative_path) is None))
 
     def run(self):
         try:
@@ -591,34 +1344,27 @@ class FileProcessorGUI:
             self.log_message("Please select at least one save option!")
             return
         
-        # Store current selections before generating files
-        current_selections = self.checkbox_tree.get_selected()
+        # Keep the selection as rules, on disk too, and put it back once the job is done
+        rules = self.checkbox_tree.selection_rules()
+        self.store_profile(LAST_SAVE_PROFILE, rules)
         
-        # Temporarily disable file monitoring
+        # Disable file monitoring until the job has finished
         self.stop_monitoring()
         
         try:
-            if self.save_structure.get() and self.save_content.get():
-                self.generate('both')
-            elif self.save_structure.get():
-                self.generate('structure')
-            elif self.save_content.get():
-                self.generate('content')
-            
-            if self.save_line_counts.get():
-                self.generate('counts')
-                
-            # Wait a short moment for files to be generated
-            self.root.after(100, lambda: self.restore_selections(current_selections))
-            
+            started = self.generate(structure=self.save_structure.get(),
+                                    content=self.save_content.get(),
+                                    counts=self.save_line_counts.get(),
+                                    on_done=lambda: self.restore_selections(rules))
         except Exception as e:
             self.log_message(f"Error during save: {str(e)}")
+            started = False
+        if not started:
+            self.restore_selections(rules)
 
-    def restore_selections(self, selections):
+    def restore_selections(self, rules):
         try:
-            for path in selections:
-                if path in self.checkbox_tree.vars:
-                    self.checkbox_tree.vars[path].set(True)
+            self.apply_selection_rules(rules)
             # Resume monitoring after restoring selections
             folder = self.folder_path.get()
             if folder:
@@ -626,18 +1372,131 @@ class FileProcessorGUI:
         except Exception as e:
             self.log_message(f"Error restoring selections: {str(e)}")
 
-class FileSystemHandler(FileSystemEventHandler):
-    def __init__(self, callback):
+    def store_profile(self, name, rules):
+        try:
+            self.profiles.save(name, self.folder_path.get(), rules)
+        except OSError as e:
+            self.log_message(f"Error saving selection profile: {str(e)}")
+            return False
+        self.profile_box["values"] = self.profiles.names()
+        return True
+
+    def save_profile(self):
+        name = self.selection_profile_var.get().strip()
+        if not name:
+            self.log_message("Enter a name for the selection profile")
+            return
+        rules = self.checkbox_tree.selection_rules()
+        if self.store_profile(name, rules):
+            self.log_message(f"Saved selection profile '{name}' ({len(rules)} rules)")
+
+    def load_profile(self):
+        name = self.selection_profile_var.get().strip()
+        rules = self.profiles.rules(name)
+        if rules is None:
+            self.log_message(f"No selection profile named '{name}'")
+            return
+        self.apply_selection_rules(rules)
+        self.log_message(f"Loaded selection profile '{name}'")
+
+    def delete_profile(self):
+        name = self.selection_profile_var.get().strip()
+        try:
+            self.profiles.delete(name)
+        except OSError as e:
+            self.log_message(f"Error deleting selection profile: {str(e)}")
+            return
+        self.profile_box["values"] = self.profiles.names()
+        self.selection_profile_var.set("")
+
+class FileSystemHandler:
+    # Watchdog only calls dispatch() on its handlers, so this does not need to
+    # subclass FileSystemEventHandler (and import watchdog) at load time.
+    # Events under paths is_ignored(relative_path, is_directory) rejects are
+    # dropped before they are queued. A batch goes to callback once nothing
+    # has arrived for window seconds, or max_delay after its first event
+    # however busy the folder stays, driven by one timer per batch rather
+    # than one per event. A batch past max_events is delivered as None,
+    # meaning "rescan".
+    handled_events = {'created', 'deleted', 'moved', 'modified'}
+
+    def __init__(self, callback, root=None, is_ignored=None, window=0.5, max_delay=3.0, max_events=MAX_FS_EVENTS):
         self.callback = callback
+        self.root = root
+        self.is_ignored = is_ignored
+        self.window = window
+        self.max_delay = max_delay
+        self.max_events = max_events
         self.timer = None
+        self.pending = []
+        self.overflowed = False
+        self.first = self.last = 0.0
+        self.lock = threading.Lock()
         
+    def dispatch(self, event):
+        self.on_any_event(event)
+
     def on_any_event(self, event):
-        # Debounce the refresh to avoid multiple rapid updates
-        if self.timer:
-            self.timer.cancel()
-        self.timer = threading.Timer(0.5, self.callback)
+        if event.event_type not in self.handled_events:
+            return
+        # Directory mtime changes carry no information the tree needs
+        if event.event_type == 'modified' and event.is_directory:
+            return
+
+        dest_path = getattr(event, 'dest_path', '')
+        if self._ignored(event.src_path, event.is_directory) and (
+                not dest_path or self._ignored(dest_path, event.is_directory)):
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if len(self.pending) >= self.max_events:
+                self.pending = []
+                self.overflowed = True
+            if not self.overflowed:
+                self.pending.append((event.event_type, event.src_path, dest_path, event.is_directory))
+            self.last = now
+            if self.timer is None:
+                self.first = now
+                self._start_timer(self.window)
+
+    def _ignored(self, path, is_directory):
+        if self.is_ignored is None or not path:
+            return False
+        relative_path = os.path.relpath(path, self.root)
+        if relative_path == os.curdir or relative_path.startswith(os.pardir):
+            return False
+        return self.is_ignored(relative_path, is_directory)
+
+    def _start_timer(self, delay):
+        self.timer = threading.Timer(delay, self.flush)
+        self.timer.daemon = True
         self.timer.start()
 
+    def flush(self):
+        with self.lock:
+            # Events since the timer was set push it back, up to max_delay
+            due = min(self.last + self.window, self.first + self.max_delay)
+            remaining = due - time.monotonic()
+            if remaining > 0:
+                self._start_timer(remaining)
+                return
+            events, self.pending = self.pending, []
+            overflowed, self.overflowed = self.overflowed, False
+            self.timer = None
+        if overflowed:
+            self.callback(None)
+        elif events:
+            self.callback(events)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = []
+            self.overflowed = False
+
 if __name__ == "__main__":
     app = FileProcessorGUI()
     app.run()
\ No newline at end of file
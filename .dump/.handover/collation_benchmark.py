@@ -0,0 +1,381 @@
+# Benchmarks for the collation pipeline. Generates a synthetic repository
+# (file count, depth, fan-out, language mix, comment density and share of
+# binary files are all settable) and times each stage on it separately,
+# writing the results as JSON so two versions can be compared.
+#
+#   python collation_benchmark.py --files 1000 10000 100000 -o bench.json
+#   python collation_benchmark.py --files 10000 --compare bench.json
+#
+# The tree-widget stages need Tk: they run on $DISPLAY, or under Xvfb when it
+# is installed, and are skipped otherwise.
+
+import os
+import sys
+import argparse
+import importlib.util
+import json
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import collation_engine as engine
+
+BENCHMARK_VERSION = 1
+DEFAULT_MIX = 'py=3,js=3,ts=2,css=1,html=1,md=1,json=1,sh=1'
+
+# Per-extension line templates: (code, line comment, block comment lines)
+TEMPLATES = {
+    '.py': ("value_{i} = compute('{i} # not a comment', {i})",
+            "# comment {i}",
+            ('"""', 'Docstring {i}.', '"""')),
+    '.js': ("const value{i} = compute('{i} // not a comment', {i});",
+            "// comment {i}",
+            ('/*', ' * block {i}', ' */')),
+    '.ts': ("let value{i}: number = compute(`{i} /* not a comment */`, {i});",
+            "// comment {i}",
+            ('/**', ' * @param block {i}', ' */')),
+    '.css': (".rule-{i} {{ color: #{i:06x}; content: '/* not a comment */'; }}",
+             "/* comment {i} */",
+             ('/*', '  block {i}', '*/')),
+    '.html': ('<div class="item-{i}" data-note="<!-- not a comment -->">{i}</div>',
+              "<!-- comment {i} -->",
+              ('<!--', '  block {i}', '-->')),
+    '.md': ("Paragraph {i} with `inline code` and a [link](#{i}).", None, None),
+    '.json': ('  "key{i}": "value {i} // not a comment",', None, None),
+    '.sh': ('echo "step {i} # not a comment" > /dev/null', "# comment {i}", None),
+}
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+def parse_mix(text):
+    # "py=3,js=1" -> [('.py', 3.0), ('.js', 1.0)]
+    mix = []
+    for item in text.split(','):
+        extension, _, weight = item.partition('=')
+        extension = '.' + extension.strip().lstrip('.')
+        if extension not in TEMPLATES:
+            raise ValueError(f"no template for {extension}; known: {', '.join(sorted(TEMPLATES))}")
+        mix.append((extension, float(weight or 1)))
+    return mix
+
+def make_source(rng, extension, lines, comment_density):
+    code, comment, block = TEMPLATES[extension]
+    out = []
+    i = 0
+    while len(out) < lines:
+        i += 1
+        roll = rng.random()
+        if comment and roll < comment_density:
+            if block and roll < comment_density / 4:
+                out.extend(line.format(i=i) for line in block)
+            else:
+                out.append(comment.format(i=i))
+        elif roll > 0.95:
+            out.append('')
+        else:
+            out.append(code.format(i=i))
+    return '\n'.join(out) + '\n'
+
+def generate_repo(root, files=1000, depth=4, fanout=6, mix=DEFAULT_MIX, comment_density=0.3, binary_share=0.01,
+                  mean_lines=60, files_per_dir=16, seed=1):
+    # Deterministic for a given seed. Returns a summary of what was written.
+    rng = random.Random(seed)
+    extensions, weights = zip(*parse_mix(mix))
+
+    # Directories breadth first up to depth, no more than the files need
+    wanted = max(1, files // max(1, files_per_dir))
+    directories = ['']
+    frontier = ['']
+    for _ in range(depth):
+        next_frontier = []
+        for parent in frontier:
+            for index in range(fanout):
+                if len(directories) >= wanted:
+                    break
+                path = os.path.join(parent, f"dir{index:03d}")
+                directories.append(path)
+                next_frontier.append(path)
+        frontier = next_frontier
+        if len(directories) >= wanted:
+            break
+    for path in directories[1:]:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+
+    total_bytes = 0
+    binaries = 0
+    for index in range(files):
+        directory = directories[index % len(directories)]
+        if rng.random() < binary_share:
+            name = f"image{index:06d}.png"
+            data = PNG_MAGIC + rng.randbytes(rng.randint(512, 64 * 1024))
+            binaries += 1
+        else:
+            extension = rng.choices(extensions, weights)[0]
+            name = f"file{index:06d}{extension}"
+            lines = max(1, int(rng.expovariate(1 / mean_lines)))
+            data = make_source(rng, extension, lines, comment_density).encode('utf-8')
+        with open(os.path.join(root, directory, name), 'wb') as f:
+            f.write(data)
+        total_bytes += len(data)
+
+    # Something for the ignore rules to do
+    with open(os.path.join(root, '.gitignore'), 'w', encoding='utf-8') as f:
+        f.write("*.log\nbuild/\n!keep.log\n")
+    return {'files': files, 'directories': len(directories), 'bytes': total_bytes, 'binary_files': binaries}
+
+@contextmanager
+def virtual_display():
+    # Yields a usable DISPLAY, starting Xvfb if there is none, or None
+    if os.environ.get('DISPLAY'):
+        yield os.environ['DISPLAY']
+        return
+    xvfb = shutil.which('Xvfb')
+    if xvfb is None:
+        yield None
+        return
+    for number in range(90, 110):
+        if not os.path.exists(f"/tmp/.X11-unix/X{number}") and not os.path.exists(f"/tmp/.X{number}-lock"):
+            break
+    else:
+        print("No free display for Xvfb between :90 and :109", file=sys.stderr)
+        yield None
+        return
+    display = f":{number}"
+    process = subprocess.Popen([xvfb, display, '-screen', '0', '1280x1024x24', '-nolisten', 'tcp'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(0.5)
+        if process.poll() is not None:
+            print(f"Xvfb exited with status {process.returncode} on {display}", file=sys.stderr)
+            yield None
+            return
+        os.environ['DISPLAY'] = display
+        yield display
+    finally:
+        os.environ.pop('DISPLAY', None)
+        process.terminate()
+        process.wait()
+
+def load_gui():
+    # The GUI script's name is not importable as-is
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'collation-engine.py')
+    spec = importlib.util.spec_from_file_location('collation_gui', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(func, repeat):
+    # Runs func repeat times; returns the timings and the last result
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return timings, result
+
+def summarise(timings, **extra):
+    summary = {'seconds': [round(t, 6) for t in timings], 'min': round(min(timings), 6),
+               'median': round(statistics.median(timings), 6)}
+    summary.update(extra)
+    return summary
+
+def bench_tree(gui, snapshot, repeat):
+    # Builds the whole tree as if every directory had been expanded, then
+    # toggles the largest top-level directory on and off
+    import tkinter as tk
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        tree = gui.FileCheckboxTree(root)
+        tree.pack()
+        entries = list(snapshot.walk())
+
+        def build():
+            tree.clear()
+            for entry, indent in entries:
+                if entry.is_dir:
+                    tree.add_item(entry.path, f"[{entry.name}]", indent, is_directory=True)
+                else:
+                    tree.add_item(entry.path, entry.name, indent)
+            root.update()
+
+        build_timings, _ = measure(build, repeat)
+        tops = [tree.ids[entry.path] for entry in snapshot.top if entry.is_dir]
+        if not tops:
+            return {'tree_build': summarise(build_timings)}
+        largest = max(tops, key=lambda node: len(tree.children[node]))
+
+        def toggle():
+            tree.toggle(largest)
+            tree.toggle(largest)
+            root.update()
+
+        toggle_timings, _ = measure(toggle, repeat)
+        return {'tree_build': summarise(build_timings, rows=len(entries)),
+                'toggle': summarise(toggle_timings, note="checks and unchecks the largest top-level directory")}
+    finally:
+        root.destroy()
+
+def bench_size(files, args, workdir):
+    root = os.path.join(workdir, f"repo-{files}")
+    started = time.perf_counter()
+    repo = generate_repo(root, files, args.depth, args.fanout, args.mix, args.comment_density,
+                         args.binary_share, args.mean_lines, args.files_per_dir, args.seed)
+    repo['generate_seconds'] = round(time.perf_counter() - started, 3)
+    repeat = args.repeat
+    stages = {}
+
+    def matcher():
+        return engine.IgnoreMatcher(engine.DEFAULT_IGNORES, gitignore=True)
+
+    # refresh_file_list scans lazily; a full scan is the cost of expanding everything
+    timings, snapshot = measure(lambda: engine.DirectorySnapshot.scan(root), repeat)
+    stages['walk'] = summarise(timings, entries=len(snapshot.entries))
+    timings, _ = measure(lambda: engine.DirectorySnapshot.scan(root, matcher()), repeat)
+    stages['walk_filtered'] = summarise(timings)
+    timings, _ = measure(lambda: engine.DirectorySnapshot.scan(root, matcher(), classify=True), repeat)
+    stages['walk_classified'] = summarise(timings)
+
+    paths = [(entry.path, entry.is_dir) for entry, _ in snapshot.walk()]
+    rules = matcher()
+    timings, _ = measure(lambda: sum(rules.is_ignored(path, is_dir) for path, is_dir in paths), repeat)
+    stages['ignore_filter'] = summarise(timings, paths=len(paths))
+
+    snapshot = engine.DirectorySnapshot.scan(root, matcher())
+    selected = [entry.path for entry, _ in snapshot.walk()]
+    output_dir = os.path.join(workdir, f"out-{files}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    timings, _ = measure(lambda: engine.generate_tree(snapshot, os.path.join(output_dir, 'file_structure.txt')),
+                         repeat)
+    stages['generate_tree'] = summarise(timings)
+
+    content_file = os.path.join(output_dir, 'combined_output.txt')
+    variants = [('combine_files', {}), ('combine_files_strip', {'remove_comments': True})]
+    if args.parallel:
+        variants.append(('combine_files_parallel', {'parallel': True}))
+    for name, settings in variants:
+        options = engine.CollationOptions(**settings)
+        timings, _ = measure(lambda: engine.combine_files(snapshot, selected, content_file, options), repeat)
+        stages[name] = summarise(timings, bytes=os.path.getsize(content_file))
+
+    # The lexer on its own, over text already in memory
+    texts = []
+    for entry, _ in snapshot.walk():
+        if not entry.is_dir:
+            with engine.SourceFile(os.path.join(root, entry.path)) as source:
+                if source.sniff().kind == 'text':
+                    texts.append((''.join(source.iter_text()), os.path.splitext(entry.name)[1]))
+    text_bytes = sum(len(text) for text, _ in texts)
+    timings, _ = measure(lambda: [engine.remove_comments(text, ext) for text, ext in texts], repeat)
+    stages['remove_comments'] = summarise(timings, chars=text_bytes)
+    timings, _ = measure(lambda: [engine.count_non_comment_lines(text, ext) for text, ext in texts], repeat)
+    stages['count_non_comment_lines'] = summarise(timings, chars=text_bytes)
+
+    if args.gui is not None:
+        stages.update(bench_tree(args.gui, snapshot, repeat))
+
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'repo': repo, 'stages': stages}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    # Prints each stage's median against the baseline; returns the regressions
+    previous = {(run['repo']['files'], stage): summary['median']
+                for run in baseline['runs'] for stage, summary in run['stages'].items()}
+    regressions = []
+    for run in results['runs']:
+        for stage, summary in run['stages'].items():
+            before = previous.get((run['repo']['files'], stage))
+            if not before:
+                continue
+            ratio = summary['median'] / before
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((run['repo']['files'], stage, ratio))
+            print(f"{run['repo']['files']:>8} {stage:<26} {before:>10.4f}s -> {summary['median']:>10.4f}s "
+                  f"x{ratio:.2f}{flag}")
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Time the collation pipeline on synthetic repositories.")
+    parser.add_argument('--files', type=int, nargs='+', default=[1000], help="file counts to generate")
+    parser.add_argument('--depth', type=int, default=4, help="maximum directory depth")
+    parser.add_argument('--fanout', type=int, default=6, help="subdirectories per directory")
+    parser.add_argument('--files-per-dir', type=int, default=16, help="average files per directory")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="language mix as ext=weight pairs")
+    parser.add_argument('--comment-density', type=float, default=0.3, help="share of lines that are comments")
+    parser.add_argument('--binary-share', type=float, default=0.01, help="share of files that are binary")
+    parser.add_argument('--mean-lines', type=int, default=60, help="average lines per source file")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage")
+    parser.add_argument('--parallel', action='store_true', help="also time parallel collation")
+    parser.add_argument('--no-gui', action='store_true', help="skip the tree-widget stages")
+    parser.add_argument('--workdir', help="where to generate the repositories (default: a temp dir)")
+    parser.add_argument('--keep', action='store_true', help="keep the generated repositories")
+    parser.add_argument('-o', '--output', help="write the results as JSON here")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare against an earlier results file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown allowed before --compare fails")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='collation-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {
+        'version': BENCHMARK_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'compare', 'workdir', 'keep')},
+        'runs': [],
+    }
+    try:
+        with virtual_display() as display:
+            args.gui = None
+            if display is not None and not args.no_gui:
+                args.gui = load_gui()
+            elif not args.no_gui:
+                print("No display; skipping the tree-widget stages", file=sys.stderr)
+            results['display'] = display if args.gui is not None else None
+            for files in args.files:
+                print(f"Benchmarking {files} files...", file=sys.stderr)
+                results['runs'].append(bench_size(files, args, workdir))
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2580 @@
+# Collation engine: walks a folder, filters it through gitignore-style rules
+# and writes the file structure, the combined file contents and per-file line
+# counts. It has no GUI or watcher dependencies, so it can be imported by
+# other tools or run headless:
+#
+#     python collation_engine.py path/to/repo --content --counts -o out/
+#
+# collation-engine.py builds the Tk front end on top of it.
+import os
+import sys
+import argparse
+import bisect
+import codecs
+import io
+import json
+import mmap
+import time
+import re
+import itertools
+import hashlib
+import heapq
+import sqlite3
+import stat
+import subprocess
+import zlib
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager, nullcontext
+
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_SIZE_LIMIT = 1024 * 1024
+DEFAULT_BATCH_SIZE = 32
+CACHE_FILE_NAME = '.collation-cache.sqlite'
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_IGNORES = ('.git', 'node_modules/', '.next/', '__pycache__/', 'package-lock.json', '*.ico', 'pastebin.*')
+METRICS_FILE_NAME = 'collation_metrics.json'
+PROFILE_FILE_NAME = 'collation_profile.prof'
+PROFILES_FILE_NAME = '.collation-profiles.json'
+FILES_TO_IGNORE = frozenset({"collation-engine.py", "collation_engine.py", "collation_benchmark.py",
+                             "combined_output.txt", "file_structure.txt", "line_counts.txt", CACHE_FILE_NAME,
+                             METRICS_FILE_NAME, PROFILE_FILE_NAME, PROFILES_FILE_NAME})
+# Content file name for each output format
+CONTENT_FILE_NAMES = {'txt': 'combined_output.txt', 'gzip': 'combined_output.txt.gz', 'jsonl': 'combined_output.jsonl'}
+# Other content outputs: chunked parts and manifest, and the indexed formats
+GENERATED_OUTPUT_RE = re.compile(
+    r'combined_output\.(part\d+\.txt|manifest\.json|txt\.gz|jsonl|txt\.gz\.index\.json|jsonl\.index\.json'
+    r'|txt\.sections\.json)$')
+CHARS_PER_TOKEN = 4  # Rough average for source code, used for token budgets
+DEDUP_MAX_ENTRIES = 64 * 1024  # Distinct digests remembered when deduplicating
+DEFAULT_PREFETCH_BYTES = 64 * 1024 * 1024  # Read-ahead buffers in flight at most
+PREFETCH_THREADS = 16
+
+SNIFF_SIZE = 8 * 1024
+
+# Leading bytes of binary formats likely to turn up in a source tree
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'PNG image'),
+    (b'\xff\xd8\xff', 'JPEG image'),
+    (b'GIF87a', 'GIF image'),
+    (b'GIF89a', 'GIF image'),
+    (b'II*\x00', 'TIFF image'),
+    (b'MM\x00*', 'TIFF image'),
+    (b'%PDF-', 'PDF document'),
+    (b'PK\x03\x04', 'ZIP archive'),
+    (b'PK\x05\x06', 'ZIP archive'),
+    (b'\x1f\x8b', 'gzip archive'),
+    (b'BZh', 'bzip2 archive'),
+    (b'\xfd7zXZ\x00', 'xz archive'),
+    (b"7z\xbc\xaf'\x1c", '7z archive'),
+    (b'\x7fELF', 'ELF binary'),
+    (b'\xca\xfe\xba\xbe', 'Java class'),
+    (b'\x00asm', 'WebAssembly module'),
+    (b'SQLite format 3\x00', 'SQLite database'),
+    (b'wOFF', 'WOFF font'),
+    (b'wOF2', 'WOFF2 font'),
+    (b'OggS', 'Ogg media'),
+    (b'ID3', 'MP3 audio'),
+    (b'fLaC', 'FLAC audio'),
+)
+GENERATED_NAMES = frozenset({
+    'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'pnpm-lock.yaml', 'bun.lockb', 'Cargo.lock',
+    'poetry.lock', 'Pipfile.lock', 'composer.lock', 'Gemfile.lock', 'go.sum', 'flake.lock', 'uv.lock',
+})
+GENERATED_SUFFIXES = (('.min.js', 'minified bundle'), ('.min.mjs', 'minified bundle'),
+                      ('.min.css', 'minified stylesheet'), ('.js.map', 'source map'), ('.css.map', 'source map'))
+GENERATED_MARKER_RE = re.compile(rb'@generated|DO NOT EDIT|auto-?generated', re.IGNORECASE)
+MINIFIED_EXTENSIONS = frozenset({'.js', '.mjs', '.cjs', '.css'})
+# Bytes that do not appear in text, whatever its 8-bit encoding
+CONTROL_BYTES = bytes(set(range(32)) - {8, 9, 10, 12, 13, 27}) + b'\x7f'
+
+Sniffed = namedtuple('Sniffed', 'kind detail')
+TEXT = Sniffed('text', '')
+NON_TEXT_KINDS = frozenset({'binary', 'generated'})
+
+def sniff_name(name):
+    # Generated files recognisable from their name alone, or None
+    if name in GENERATED_NAMES:
+        return Sniffed('generated', 'lockfile')
+    lower = name.lower()
+    for suffix, detail in GENERATED_SUFFIXES:
+        if lower.endswith(suffix):
+            return Sniffed('generated', detail)
+    return None
+
+def sniff_bytes(sample, name):
+    # Classify a file from its first SNIFF_SIZE bytes
+    for magic, detail in MAGIC_NUMBERS:
+        if sample.startswith(magic):
+            return Sniffed('binary', detail)
+    if b'\x00' in sample:
+        return Sniffed('binary', 'binary data')
+    if sample and len(sample) - len(sample.translate(None, CONTROL_BYTES)) > len(sample) // 10:
+        return Sniffed('binary', 'binary data')
+    if GENERATED_MARKER_RE.search(sample, 0, 1024):
+        return Sniffed('generated', 'marked as generated')
+    # Bundlers put whole modules on one line; real source averages far less
+    if (os.path.splitext(name)[1].lower() in MINIFIED_EXTENSIONS and len(sample) >= 2048
+            and sample.count(b'\n') < len(sample) // 500):
+        return Sniffed('generated', 'minified bundle')
+    return TEXT
+
+def classify_file(file_path, name=None, data=None):
+    # data is the file's contents if they have been read already
+    name = name or os.path.basename(file_path)
+    sniffed = sniff_name(name)
+    if sniffed is not None:
+        return sniffed
+    if data is not None:
+        return sniff_bytes(data[:SNIFF_SIZE], name)
+    with open(file_path, 'rb') as f:
+        return sniff_bytes(f.read(SNIFF_SIZE), name)
+
+def describe_non_text(sniffed, size):
+    return f"{sniffed.kind.capitalize()} file not included ({sniffed.detail}, {format_size(size)})\n"
+
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class SourceFile:
+    # Raw bytes of a file, read once. Regular files are memory-mapped, so the
+    # encoding check, the latin-1 fallback and the chunked decode all work on
+    # the same pages without copying the whole file into Python memory.
+    # data stands in for the file when its bytes have been read ahead.
+    def __init__(self, path, data=None):
+        self.path = path
+        self.file = None
+        self.buffer = b''
+        self.data = data
+
+    def __enter__(self):
+        if self.data is not None:
+            self.buffer = self.data
+            return self
+        self.file = open(self.path, 'rb')
+        try:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty and special files cannot be mapped
+            self.buffer = self.file.read()
+        return self
+
+    def __exit__(self, *exc_info):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        if self.file is not None:
+            self.file.close()
+
+    def _decode(self, encoding, chunk_size):
+        # Universal newlines, matching what open(..., 'r') used to produce
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+        for start in range(0, len(self.buffer), chunk_size):
+            text = decoder.decode(self.buffer[start:start + chunk_size])
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def detect_encoding(self, chunk_size=READ_CHUNK_SIZE):
+        try:
+            for _ in self._decode('utf-8', chunk_size):
+                pass
+            return 'utf-8'
+        except UnicodeDecodeError:
+            return 'latin-1'
+
+    def iter_text(self, chunk_size=READ_CHUNK_SIZE):
+        return self._decode(self.detect_encoding(chunk_size), chunk_size)
+
+    def digest(self):
+        return content_digest(self.buffer)
+
+    def sniff(self):
+        name = os.path.basename(self.path)
+        return sniff_name(name) or sniff_bytes(self.buffer[:SNIFF_SIZE], name)
+
+class NullOutput:
+    # Stands in for the content file on counts-only runs
+    paths = ()
+
+    def write(self, text):
+        return len(text)
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        pass
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def directory_header(dir_path):
+    return f"\n{'='*11}\nDirectory: {dir_path}\n{'='*11}\n\n"
+
+def file_header(relative_path, continued=False):
+    return f"File: {relative_path}{' (continued)' if continued else ''}\n{'-'*20}\n\n"
+
+class FlatOutput:
+    # The single combined_output.txt. combine_files drives every content
+    # output through begin_file, write and end_file (which gets the source's
+    # digest when it was read); here they are plain writes.
+    def __init__(self, output_file, preamble=''):
+        self.output_file = output_file
+        self.paths = [output_file]
+        self.file = open(output_file, 'w', encoding='utf-8')
+        self.write = self.file.write
+        self.write(preamble)
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        self.write(header)
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        self.write(trailer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is not None:
+            _remove_files([self.output_file])
+
+class ChunkedOutput:
+    # Streams the combined output into numbered parts (combined_output.part001.txt,
+    # ...) that each stay under a byte budget, or an approximate token budget
+    # measured as CHARS_PER_TOKEN characters per token. combine_files calls
+    # begin_file before each file so a part only ends between files; a file
+    # too big for a part of its own is split at line ends, and a single line
+    # longer than a part runs over the budget rather than being cut. Every
+    # part repeats the preamble and the header of the directory being
+    # written, and manifest.json maps each file to the part(s) holding it.
+    def __init__(self, output_file, max_bytes=0, max_tokens=0, preamble=''):
+        base, ext = os.path.splitext(output_file)
+        self.pattern = f"{base}.part{{:03d}}{ext or '.txt'}"
+        self.manifest_file = self.manifest_path(output_file)
+        self.paths = [self.manifest_file]
+        self.by_bytes = bool(max_bytes)
+        self.limit = max_bytes or max_tokens * CHARS_PER_TOKEN
+        self.preamble = preamble
+        self.parts = []
+        self.files = {}
+        self.out = None
+        self.used = 0
+        self.reserved = 0  # Size of the headers a part starts with
+        self.dir_path = ''
+        self.current = None
+        self.partial = ''  # Start of a line whose end has not been written yet
+        self._next_part()
+
+    @staticmethod
+    def manifest_path(output_file):
+        return os.path.splitext(output_file)[0] + '.manifest.json'
+
+    def measure(self, text):
+        return len(text.encode('utf-8')) if self.by_bytes else len(text)
+
+    def _emit(self, text, size=None):
+        self.out.write(text)
+        self.used += self.measure(text) if size is None else size
+
+    def _next_part(self):
+        if self.out is not None:
+            self.out.close()
+        path = self.pattern.format(len(self.parts) + 1)
+        self.parts.append(path)
+        self.paths.append(path)
+        self.out = open(path, 'w', encoding='utf-8')
+        self.used = 0
+        self._emit(self.preamble)
+        if self.dir_path:
+            self._emit(directory_header(self.dir_path))
+        if self.current is not None:
+            self._emit(file_header(self.current, continued=True))
+            self.files[self.current].append(len(self.parts))
+        self.reserved = self.used
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        # estimate is the expected size of the file's content
+        if self.used > self.reserved and self.used + self.measure(header) + estimate + 2 > self.limit:
+            if dir_path != self.dir_path:
+                self.dir_path = ''  # The header below already opens the new directory
+            self._next_part()
+        self.dir_path = dir_path
+        opening = self.used == self.reserved
+        self._emit(header)
+        if opening:
+            # A header that opens a part stays with the file's first line,
+            # however long that is
+            self.reserved = self.used
+        self.current = relative_path
+        self.files[relative_path] = [len(self.parts)]
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        if self.partial:
+            text, self.partial = self.partial, ''
+            self._place(text)
+        self.current = None
+        self._emit(trailer)
+
+    def _cut(self, text, room):
+        # Length of the longest prefix of text ending in a newline that fits
+        # in room, or 0 if there is none
+        cut = text.rfind('\n', 0, room) + 1
+        while cut and self.measure(text[:cut]) > room:
+            cut = text.rfind('\n', 0, cut - 1) + 1
+        return cut
+
+    def write(self, text):
+        length = len(text)
+        if self.current is None:
+            self._emit(text)
+            return length
+        # Only whole lines are placed, so a cut never falls inside one; the
+        # unfinished last line waits for the rest of it
+        text = self.partial + text
+        end = text.rfind('\n') + 1
+        self.partial = text[end:]
+        if end:
+            self._place(text[:end])
+        return length
+
+    def _place(self, text):
+        size = self.measure(text)
+        # Leave room for the blank lines that close the file
+        limit = self.limit - 2
+        while text and self.used + size > limit:
+            cut = self._cut(text, max(0, limit - self.used))
+            if not cut:
+                if self.used > self.reserved:
+                    self._next_part()
+                    continue
+                # A single line longer than a part; let this part run over
+                cut = text.find('\n') + 1 or len(text)
+            self._emit(text[:cut])
+            text = text[cut:]
+            size = self.measure(text)
+        if text:
+            self._emit(text, size)
+
+    def close(self):
+        self.out.close()
+        # Drop parts left over from an earlier, longer run
+        number = len(self.parts) + 1
+        while os.path.exists(self.pattern.format(number)):
+            os.remove(self.pattern.format(number))
+            number += 1
+        manifest_dir = os.path.dirname(self.manifest_file)
+        manifest = {
+            'budget': {'bytes' if self.by_bytes else 'tokens':
+                       self.limit if self.by_bytes else self.limit // CHARS_PER_TOKEN},
+            'parts': [os.path.relpath(path, manifest_dir) for path in self.parts],
+            'files': self.files,
+        }
+        with open(self.manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+
+    def discard(self):
+        self.out.close()
+        _remove_files(self.parts + [self.manifest_file])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+class IndexedOutput:
+    # Base for content files with a sidecar index (<output>.index.json) that
+    # gives each file's offset and stored length in the output, the size, line
+    # count and blake2b hash of its content, so CollationReader can pull one
+    # file out with a single seek instead of scanning the whole dump
+    format = None
+
+    def __init__(self, output_file, preamble=''):
+        self.output_file = output_file
+        self.index_file = self.index_path(output_file)
+        self.paths = [output_file, self.index_file]
+        self.comments_removed = bool(preamble)
+        self.out = open(output_file, 'wb')
+        self.files = []
+        self.current = None
+        self.hash = None
+        self.size = 0
+
+    @staticmethod
+    def index_path(output_file):
+        return output_file + '.index.json'
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        self.current = relative_path
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.size = 0
+        self._begin(header)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.hash.update(data)
+        self.size += len(data)
+        self._write(data)
+        return len(text)
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        record = {'path': self.current, 'size': self.size, 'lines': line_count, 'hash': self.hash.hexdigest()}
+        self._end(trailer, record)
+        self.files.append(record)
+        self.current = None
+
+    def close(self):
+        self.out.close()
+        index = {'format': self.format, 'comments_removed': self.comments_removed, 'files': self.files}
+        with open(self.index_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.out.close()
+            _remove_files([self.output_file, self.index_file])
+
+class GzipFramedOutput(IndexedOutput):
+    # combined_output.txt.gz: one gzip member per file holding exactly what the
+    # flat format would have (headers included). Concatenated members are a
+    # valid gzip stream, so zcat still gives combined_output.txt, and any one
+    # member can be decompressed on its own.
+    format = 'gzip'
+
+    def __init__(self, output_file, preamble='', level=6):
+        super().__init__(output_file, preamble)
+        self.level = level
+        if preamble:
+            self.out.write(zlib.compress(preamble.encode('utf-8'), level, wbits=31))
+
+    def _begin(self, header):
+        self.offset = self.out.tell()
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        data = header.encode('utf-8')
+        self.start = len(data)
+        self._write(data)
+
+    def _write(self, data):
+        self.out.write(self.compressor.compress(data))
+
+    def _end(self, trailer, record):
+        self._write(trailer.encode('utf-8'))
+        self.out.write(self.compressor.flush())
+        self.compressor = None
+        record.update(offset=self.offset, length=self.out.tell() - self.offset, start=self.start)
+
+class JsonlOutput(IndexedOutput):
+    # combined_output.jsonl: a first record with run settings, then one
+    # {"path", "lines", "hash", "content"} record per file. Headers are left
+    # out since every record names its file; a file's content is held until
+    # its record is written.
+    format = 'jsonl'
+
+    def __init__(self, output_file, preamble=''):
+        super().__init__(output_file, preamble)
+        self.out.write(json.dumps({'comments_removed': self.comments_removed}).encode('utf-8') + b'\n')
+
+    def _begin(self, header):
+        self.pending = []
+
+    def _write(self, data):
+        self.pending.append(data)
+
+    def _end(self, trailer, record):
+        content = b''.join(self.pending).decode('utf-8')
+        self.pending = None
+        line = {'path': record['path'], 'lines': record['lines'], 'hash': record['hash'], 'content': content}
+        offset = self.out.tell()
+        self.out.write(json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n')
+        record.update(offset=offset, length=self.out.tell() - offset, start=0)
+
+class CollationReader:
+    # Random access to a content file written in an indexed format:
+    #   with CollationReader('combined_output.txt.gz') as reader:
+    #       text = reader.read('src/app.py')
+    def __init__(self, output_file):
+        with open(IndexedOutput.index_path(output_file), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.format = index['format']
+        self.comments_removed = index['comments_removed']
+        self.entries = {record['path']: record for record in index['files']}
+        self.file = open(output_file, 'rb')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def info(self, path):
+        # The index record: offset, length, start, size, lines and hash
+        return self.entries[path]
+
+    def read_bytes(self, path, verify=False):
+        record = self.entries[path]
+        self.file.seek(record['offset'])
+        data = self.file.read(record['length'])
+        if self.format == 'gzip':
+            content = zlib.decompress(data, 31)[record['start']:record['start'] + record['size']]
+        else:
+            content = json.loads(data)['content'].encode('utf-8')
+        if verify and hashlib.blake2b(content, digest_size=16).hexdigest() != record['hash']:
+            raise ValueError(f"content of {path} does not match its index entry")
+        return content
+
+    def read(self, path, verify=False):
+        return self.read_bytes(path, verify).decode('utf-8')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def file_digest(path):
+    with SourceFile(path) as source:
+        return source.digest()
+
+def copy_range(source, target, offset, length):
+    # Appends length bytes of source, from offset, to target. copy_file_range
+    # keeps the copy in the kernel, and shares extents outright on
+    # copy-on-write filesystems; anything it cannot do falls back to read/write.
+    target.flush()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(source.fileno(), target.fileno(), length, offset)
+                if not copied:
+                    break
+                offset += copied
+                length -= copied
+        except OSError:
+            pass
+        target.seek(0, os.SEEK_END)
+    source.seek(offset)
+    while length > 0:
+        data = source.read(min(length, 1024 * 1024))
+        if not data:
+            raise OSError(f"{source.name} ended before the copied range")
+        target.write(data)
+        length -= len(data)
+
+class IncrementalOutput:
+    # The flat combined_output.txt, rebuilt from the previous one where it
+    # can be. A sidecar (<output>.sections.json) records every file's section:
+    # where its file header starts in the output, how long it runs, and the
+    # source's size, mtime, hash and line count. Sections of files that have
+    # not changed are copied over as byte ranges and everything else is
+    # regenerated, which gives exactly what a full run would write. The new
+    # output goes to a temp file that replaces the old one only once it is
+    # complete. The sidecar is only trusted while its settings and the output
+    # file's size and mtime still match.
+    SECTIONS_VERSION = 1
+
+    def __init__(self, output_file, root, options, preamble=''):
+        self.output_file = output_file
+        self.sections_file = self.sections_path(output_file)
+        self.paths = [output_file, self.sections_file]
+        self.root = root
+        self.settings = {'version': self.SECTIONS_VERSION, 'remove_comments': bool(preamble),
+                         'size_limit': options.size_limit, 'non_text': options.non_text,
+                         'rules': rules_fingerprint()}
+        self.previous = self._load_previous()
+        self.old = open(output_file, 'rb') if self.previous else None
+        self.temp_file = output_file + '.tmp'
+        self.raw = open(self.temp_file, 'wb')
+        # Same newline handling as open(output_file, 'w')
+        self.text = io.TextIOWrapper(self.raw, encoding='utf-8')
+        self.write = self.text.write
+        self.sections = []
+        self.reused = 0
+        self.states = {}  # Path -> (size, mtime) as unchanged() saw it
+        self.current = None
+        self.write(preamble)
+
+    @staticmethod
+    def sections_path(output_file):
+        return output_file + '.sections.json'
+
+    def _load_previous(self):
+        try:
+            with open(self.sections_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            st = os.stat(self.output_file)
+        except (OSError, ValueError):
+            return {}
+        if (manifest.get('settings') != self.settings or manifest.get('output_size') != st.st_size
+                or manifest.get('output_mtime_ns') != st.st_mtime_ns):
+            return {}
+        return {section['path']: section for section in manifest['sections']}
+
+    def _position(self):
+        self.text.flush()
+        return self.raw.tell()
+
+    def unchanged(self, entry):
+        # entry's previous section if the file has not changed since, else
+        # None. entry's size and mtime must be fresh from a stat, not from the
+        # listing; they are also what the new section is recorded with.
+        self.states[entry.path] = (entry.size, entry.mtime)
+        section = self.previous.get(entry.path)
+        if section is None:
+            return None
+        full_path = os.path.join(self.root, entry.path)
+        if section['size'] != entry.size:
+            return None
+        if section['mtime'] != entry.mtime:
+            # Touched; still reusable if the bytes are the same
+            try:
+                if section['hash'] is None or file_digest(full_path) != section['hash']:
+                    return None
+            except OSError:
+                return None
+        return section
+
+    def copy_section(self, entry, section, dir_header):
+        self.write(dir_header)
+        offset = self._position()
+        copy_range(self.old, self.raw, section['offset'], section['length'])
+        self.sections.append(dict(section, mtime=entry.mtime, offset=offset))
+        self.reused += 1
+        return section['lines']
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        block = file_header(relative_path)
+        self.write(header[:len(header) - len(block)])
+        # Size and mtime were taken before the file is read, so a change made
+        # while it is being read shows up as a mismatch next time. A file
+        # that could not be stat'ed is not reused.
+        self.current = (relative_path, self._position(), self.states.get(relative_path))
+        self.write(block)
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        # digest is the hash of the bytes the section was made from, when the
+        # file was read; without one only an untouched file can reuse it
+        self.write(trailer)
+        relative_path, offset, state = self.current
+        self.current = None
+        if not reusable or state is None:
+            return  # Regenerated next time
+        size, mtime = state
+        self.sections.append({'path': relative_path, 'size': size, 'mtime': mtime, 'hash': digest,
+                              'offset': offset, 'length': self._position() - offset, 'lines': line_count})
+
+    def close(self):
+        self.text.close()
+        if self.old is not None:
+            self.old.close()
+        os.replace(self.temp_file, self.output_file)
+        st = os.stat(self.output_file)
+        manifest = {'settings': self.settings, 'output_size': st.st_size, 'output_mtime_ns': st.st_mtime_ns,
+                    'sections': self.sections}
+        temp_sections = self.sections_file + '.tmp'
+        with open(temp_sections, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(temp_sections, self.sections_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # The previous output and its sidecar stay as they were
+        self.text.close()
+        if self.old is not None:
+            self.old.close()
+        _remove_files([self.temp_file])
+
+class DuplicateTracker:
+    # Finds byte-identical files as combine_files reads them: a file whose
+    # digest (from that same read, the cache or its previous section) repeats
+    # an earlier one's is a copy of it. Only files sharing their size with
+    # another candidate are tracked, and at most max_entries distinct digests
+    # are remembered; past that, new files are no longer deduplicated.
+    def __init__(self, entries, max_entries=DEDUP_MAX_ENTRIES):
+        sizes = Counter(entry.size for entry in entries)
+        self.candidates = {entry.path for entry in entries if entry.size and sizes[entry.size] > 1}
+        self.max_entries = max_entries
+        self.first = {}
+
+    def original(self, relative_path, digest):
+        # The earlier file relative_path is a copy of, if any
+        if digest is None:
+            return None
+        original = self.first.get(digest)
+        if original is None and len(self.first) < self.max_entries:
+            self.first[digest] = relative_path
+        return original
+
+def open_content_output(output_file, options, preamble='', root=None):
+    if not output_file:
+        return NullOutput()
+    if options.output_format == 'gzip':
+        return GzipFramedOutput(output_file, preamble)
+    if options.output_format == 'jsonl':
+        return JsonlOutput(output_file, preamble)
+    if options.chunked:
+        return ChunkedOutput(output_file, options.chunk_bytes, options.chunk_tokens, preamble)
+    if options.incremental and root is not None:
+        return IncrementalOutput(output_file, root, options, preamble)
+    return FlatOutput(output_file, preamble)
+
+def iter_lines(chunks, sink=None):
+    # Split a stream of text chunks into lines, optionally passing every chunk
+    # on to sink (e.g. an output file's write) as it goes by
+    partial = ''
+    for chunk in chunks:
+        if sink is not None:
+            sink(chunk)
+        lines = chunk.split('\n')
+        if len(lines) == 1:
+            partial += chunk
+            continue
+        lines[0] = partial + lines[0]
+        partial = lines.pop()
+        yield from lines
+    yield partial
+
+class LanguageSpec:
+    # Comment and string syntax for one language family. The opener regex is
+    # compiled once, when the language is registered.
+    def __init__(self, name, line_comments=(), block_comments=(), strings=(),
+                 multiline_strings=(), docstrings=False):
+        self.name = name
+        self.line_comments = tuple(line_comments)
+        self.block_comments = dict(block_comments)  # Opener -> closer
+        self.strings = tuple(strings)  # End at the closing quote or the line
+        self.multiline_strings = tuple(multiline_strings)
+        self.docstrings = docstrings  # Statement-level triple quotes are comments
+        openers = (self.line_comments + tuple(self.block_comments) + self.strings
+                   + self.multiline_strings)
+        # Longest first so that """ wins over "
+        self.opener_re = re.compile('|'.join(re.escape(opener) for opener in sorted(openers, key=len, reverse=True))) \
+            if openers else None
+        self.closer_re = {quote: re.compile(r'\\.|' + re.escape(quote))
+                          for quote in self.strings + self.multiline_strings}
+
+# Bump whenever CommentLexer changes behaviour so cached results are dropped
+LEXER_VERSION = 1
+LANGUAGES = {}
+EXTENSION_LANGUAGES = {}
+
+def register_language(spec, extensions):
+    LANGUAGES[spec.name] = spec
+    for extension in extensions:
+        EXTENSION_LANGUAGES[extension] = spec
+
+def get_language(file_extension):
+    # Unknown extensions fall back to C-style rules, as they always have
+    ext = os.path.splitext(file_extension.lower())[1] or file_extension.lower()
+    return EXTENSION_LANGUAGES.get(ext, LANGUAGES['c'])
+
+register_language(LanguageSpec('c', line_comments=['//'], block_comments={'/*': '*/'},
+                               strings=['"', "'"], multiline_strings=['`']),
+                  ['.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx', '.java', '.c', '.h',
+                   '.cpp', '.hpp', '.cs', '.go', '.kt', '.swift'])
+register_language(LanguageSpec('python', line_comments=['#'], strings=['"', "'"],
+                               multiline_strings=['"""', "'''"], docstrings=True),
+                  ['.py', '.pyw', '.pyi'])
+register_language(LanguageSpec('markup', block_comments={'<!--': '-->'}),
+                  ['.html', '.htm', '.xml', '.svg', '.vue'])
+register_language(LanguageSpec('css', block_comments={'/*': '*/'}, strings=['"', "'"]),
+                  ['.css', '.scss', '.less'])
+register_language(LanguageSpec('hash', line_comments=['#'], strings=['"', "'"]),
+                  ['.sh', '.bash', '.yml', '.yaml', '.toml', '.rb'])
+register_language(LanguageSpec('plain'), ['.md', '.txt', '.json', '.csv'])
+
+class CommentLexer:
+    # Line-fed state machine that removes comments while leaving string
+    # literals alone, so "http://..." survives. State carries across lines for
+    # block comments and multi-line strings, which lets it run over a stream.
+    def __init__(self, spec):
+        self.spec = spec
+        self.closer = None  # Set while inside a block comment
+        self.quote = None  # Set while inside a multi-line string
+        self.hidden = False  # The open string is a docstring
+
+    def strip_line(self, line):
+        spec = self.spec
+        if spec.opener_re is None:
+            return line.rstrip()
+        out = []
+        pos = 0
+        end = len(line)
+        while pos < end:
+            if self.closer is not None:
+                index = line.find(self.closer, pos)
+                if index == -1:
+                    break
+                pos = index + len(self.closer)
+                self.closer = None
+            elif self.quote is not None:
+                start, hidden = pos, self.hidden
+                pos = self._close_string(line, pos)
+                if not hidden:
+                    out.append(line[start:pos])
+            else:
+                match = spec.opener_re.search(line, pos)
+                if match is None:
+                    out.append(line[pos:])
+                    break
+                token = match.group()
+                out.append(line[pos:match.start()])
+                pos = match.end()
+                if token in spec.line_comments:
+                    break
+                if token in spec.block_comments:
+                    self.closer = spec.block_comments[token]
+                    continue
+                self.quote = token
+                self.hidden = (spec.docstrings and token in spec.multiline_strings
+                               and not ''.join(out).strip())
+                if not self.hidden:
+                    out.append(token)
+        if self.quote in spec.strings:
+            # Single-line strings never outlive their line
+            self.quote = None
+        return ''.join(out).rstrip()
+
+    def _close_string(self, line, pos):
+        for match in self.spec.closer_re[self.quote].finditer(line, pos):
+            if match.group() == self.quote:
+                self.quote = None
+                self.hidden = False
+                return match.end()
+        return len(line)
+
+def scan_source(lines, file_extension, keep=None):
+    # One pass over the lines of a file. Returns the number of lines that
+    # still hold code once comments are gone, passing each such line (with
+    # comments stripped) to keep when given.
+    lexer = CommentLexer(get_language(file_extension))
+    strip_line = lexer.strip_line
+    count = 0
+    for line in lines:
+        stripped = strip_line(line)
+        if stripped.strip():
+            count += 1
+            if keep is not None:
+                keep(stripped)
+    return count
+
+def remove_comments(content, file_extension):
+    kept = []
+    scan_source(content.split('\n'), file_extension, kept.append)
+    return '\n'.join(kept)
+
+def count_non_comment_lines(content, file_extension):
+    # content may be a string or an iterable of lines
+    lines = content.split('\n') if isinstance(content, str) else content
+    return scan_source(lines, file_extension)
+
+def strip_and_count(content, file_extension):
+    # Stripped text and line count from the same pass
+    kept = []
+    count = scan_source(content.split('\n'), file_extension, kept.append)
+    return '\n'.join(kept), count
+
+def rules_fingerprint():
+    # Changes whenever the comment-stripping rules do
+    parts = [str(LEXER_VERSION)]
+    for ext, spec in sorted(EXTENSION_LANGUAGES.items()):
+        parts.append(f"{ext}={spec.name}:{spec.line_comments}:{sorted(spec.block_comments.items())}:"
+                     f"{spec.strings}:{spec.multiline_strings}:{spec.docstrings}")
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+CachedResult = namedtuple('CachedResult', 'line_count content digest')
+
+class ResultCache:
+    # SQLite store of per-file results, so unchanged files skip the lexer on
+    # the next save. Rows are keyed by absolute path and settings and are
+    # valid while size and mtime match; a matching content digest revives a
+    # row whose mtime moved (checkouts, touch). With comments removed the
+    # stripped text is kept too, zlib-compressed, so hits need no read at
+    # all. Least recently used rows are evicted past max_bytes, and the whole
+    # cache is dropped when the comment rules change.
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "path TEXT, settings TEXT, size INTEGER, mtime REAL, digest TEXT, line_count INTEGER, "
+            "content BLOB, stored_bytes INTEGER, last_used REAL, PRIMARY KEY (path, settings))")
+        fingerprint = rules_fingerprint()
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+        if row is None or row[0] != fingerprint:
+            self.conn.execute("DELETE FROM results")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('rules', ?)", (fingerprint,))
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _result(self, path, settings, line_count, content, digest):
+        self.conn.execute("UPDATE results SET last_used = ? WHERE path = ? AND settings = ?",
+                          (time.time(), path, settings))
+        return CachedResult(line_count, zlib.decompress(content).decode('utf-8') if content is not None else None,
+                            digest)
+
+    def lookup(self, path, size, mtime, settings):
+        row = self.conn.execute(
+            "SELECT line_count, content, digest FROM results "
+            "WHERE path = ? AND settings = ? AND size = ? AND mtime = ?",
+            (path, settings, size, mtime)).fetchone()
+        return self._result(path, settings, *row) if row else None
+
+    def lookup_digest(self, path, digest, settings, size, mtime):
+        row = self.conn.execute(
+            "SELECT line_count, content, digest FROM results WHERE path = ? AND settings = ? AND digest = ?",
+            (path, settings, digest)).fetchone()
+        if not row:
+            return None
+        self.conn.execute("UPDATE results SET size = ?, mtime = ? WHERE path = ? AND settings = ?",
+                          (size, mtime, path, settings))
+        return self._result(path, settings, *row)
+
+    def store(self, path, size, mtime, settings, digest, line_count, content=None):
+        blob = zlib.compress(content.encode('utf-8')) if content is not None else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, settings, size, mtime, digest, line_count, blob,
+             len(path) + 64 + (len(blob) if blob else 0), time.time()))
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for path, settings, stored_bytes in self.conn.execute(
+                "SELECT path, settings, stored_bytes FROM results ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((path, settings))
+            total -= stored_bytes
+        self.conn.executemany("DELETE FROM results WHERE path = ? AND settings = ?", doomed)
+
+    def clear(self):
+        self.conn.execute("DELETE FROM results")
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+def collate_file(file_path, remove_comments_enabled, sniff=False, timed=False):
+    # Read, count and optionally strip one file. Runs in worker processes, so
+    # errors come back as values rather than exceptions. With sniff, a binary
+    # or generated file comes back as its Sniffed result without being decoded.
+    # With timed, the last item is (read, decode, lex) seconds.
+    file_extension = os.path.splitext(file_path)[1]
+    timings = None
+    try:
+        started = time.perf_counter() if timed else 0.0
+        with SourceFile(file_path) as source:
+            sniffed = source.sniff() if sniff else TEXT
+            if sniffed.kind in NON_TEXT_KINDS:
+                return None, 0, None, None, sniffed, None
+            digest = source.digest()
+            read_done = time.perf_counter() if timed else 0.0
+            content = ''.join(source.iter_text())
+        decode_done = time.perf_counter() if timed else 0.0
+        if remove_comments_enabled:
+            content, line_count = strip_and_count(content, file_extension)
+        else:
+            line_count = count_non_comment_lines(content, file_extension)
+        if timed:
+            timings = (read_done - started, decode_done - read_done, time.perf_counter() - decode_done)
+        return content, line_count, None, digest, sniffed, timings
+    except Exception as e:
+        return None, 0, str(e), None, None, None
+
+def collate_batch(file_paths, remove_comments_enabled, sniff=False, timed=False):
+    return [collate_file(file_path, remove_comments_enabled, sniff, timed) for file_path in file_paths]
+
+def iter_parallel_results(file_paths, remove_comments_enabled, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                          sniff=False, timed=False):
+    # Yields collate_file results in input order. Only a couple of batches per
+    # worker are in flight at once, so results never pile up in memory ahead
+    # of the writer.
+    from concurrent.futures import ProcessPoolExecutor
+
+    batches = iter([file_paths[i:i + batch_size] for i in range(0, len(file_paths), batch_size)])
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        in_flight = (workers or os.cpu_count() or 1) * 2
+        pending.extend(executor.submit(collate_batch, batch, remove_comments_enabled, sniff, timed)
+                       for batch in itertools.islice(batches, in_flight))
+        while pending:
+            results = pending.popleft().result()
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(executor.submit(collate_batch, batch, remove_comments_enabled, sniff, timed))
+            yield from results
+    finally:
+        # A cancelled job closes this generator early; drop the queued
+        # batches instead of waiting for them
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def iter_prefetched(file_paths, sizes, read_ahead, max_bytes=DEFAULT_PREFETCH_BYTES):
+    # Yields (data, error) for each path in order while threads open and read
+    # up to read_ahead files further on, so per-file round trips on network
+    # filesystems overlap instead of adding up. Files are admitted by their
+    # listed sizes while the in-flight total stays under max_bytes; a single
+    # file larger than that is still read, on its own.
+    from concurrent.futures import ThreadPoolExecutor
+
+    queued = iter(zip(file_paths, sizes))
+    upcoming = next(queued, None)
+    executor = ThreadPoolExecutor(max_workers=min(read_ahead, PREFETCH_THREADS))
+    pending = deque()
+    in_flight = 0
+    try:
+        while True:
+            while upcoming is not None and not (pending and (len(pending) >= read_ahead
+                                                             or in_flight + upcoming[1] > max_bytes)):
+                file_path, size = upcoming
+                pending.append((executor.submit(read_file, file_path), size))
+                in_flight += size
+                upcoming = next(queued, None)
+            if not pending:
+                return
+            future, size = pending.popleft()
+            in_flight -= size
+            try:
+                yield future.result(), None
+            except OSError as e:
+                yield None, e
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def stat_file(file_path):
+    # None if the file cannot be stat'ed; reading it reports why
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
+
+def stat_files(file_paths, threads=0):
+    # stat_file for each path, in order. With threads the calls overlap like
+    # prefetched reads do, instead of costing a round trip each in turn.
+    if not threads:
+        return [stat_file(file_path) for file_path in file_paths]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(threads, PREFETCH_THREADS)) as executor:
+        return list(executor.map(stat_file, file_paths))
+
+class IgnoreMatcher:
+    # Compiled gitignore-style matcher. Patterns support *, ?, [...], **,
+    # a leading or inner / to anchor, a trailing / for directories only and
+    # ! to re-include. Consecutive rules of the same polarity are folded into
+    # one regex, so each path costs a handful of matches however many
+    # patterns there are. Paths are tested as "a/b" for files and "a/b/" for
+    # directories so directory-only rules need no separate pass.
+    def __init__(self, patterns=(), overrides=(), gitignore=False):
+        self.gitignore = gitignore
+        self.rules = {}  # Base directory -> compiled groups, last one wins
+        self.overrides = []
+        if patterns:
+            self.add_patterns(patterns)
+        if overrides:
+            self.overrides = self._compile(overrides)
+
+    @staticmethod
+    def _translate_segment(segment):
+        regex = []
+        i = 0
+        while i < len(segment):
+            char = segment[i]
+            if char == '\\' and i + 1 < len(segment):
+                i += 1
+                regex.append(re.escape(segment[i]))
+            elif char == '*':
+                regex.append('[^/]*')
+            elif char == '?':
+                regex.append('[^/]')
+            elif char == '[':
+                end = segment.find(']', i + 2)
+                if end == -1:
+                    regex.append(re.escape(char))
+                else:
+                    body = segment[i + 1:end]
+                    if body.startswith('!'):
+                        body = '^' + body[1:]
+                    regex.append('[' + body + ']')
+                    i = end
+            else:
+                regex.append(re.escape(char))
+            i += 1
+        return ''.join(regex)
+
+    @classmethod
+    def _translate(cls, pattern):
+        # Returns (regex, negate), or None for blanks and comments
+        if not pattern.endswith('\\ '):
+            pattern = pattern.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return None
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\#') or pattern.startswith('\\!'):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return None
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        segments = pattern.split('/')
+        regex = [] if anchored else ['(?:.*/)?']
+        for i, segment in enumerate(segments):
+            last = i == len(segments) - 1
+            if segment == '**':
+                regex.append('.*' if last else '(?:.*/)?')
+            else:
+                regex.append(cls._translate_segment(segment) + ('' if last else '/'))
+        regex.append('/' if dir_only else '/?')
+        return ''.join(regex), negate
+
+    @classmethod
+    def _compile(cls, patterns):
+        groups = []
+        for pattern in patterns:
+            translated = cls._translate(pattern)
+            if translated is None:
+                continue
+            regex, negate = translated
+            if groups and groups[-1][1] == negate:
+                groups[-1][0].append(regex)
+            else:
+                groups.append(([regex], negate))
+        return [(re.compile('|'.join(regexes)), negate) for regexes, negate in groups]
+
+    def add_patterns(self, patterns, base=""):
+        base = base.replace(os.sep, '/')
+        self.rules.setdefault(base, []).extend(self._compile(patterns))
+
+    def add_gitignore(self, path, base=""):
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                self.add_patterns(f.read().splitlines(), base)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _decide(groups, candidate):
+        for regex, negate in reversed(groups):
+            if regex.fullmatch(candidate):
+                return not negate
+        return None
+
+    def is_ignored(self, relative_path, is_dir):
+        # Decides a single entry, assuming its parent directory is not ignored
+        path = relative_path.replace(os.sep, '/')
+        suffix = '/' if is_dir else ''
+        if self.overrides:
+            decision = self._decide(self.overrides, path + suffix)
+            if decision is not None:
+                return decision
+
+        # Deeper .gitignore files take precedence over shallower ones
+        base = path
+        while base:
+            base = base.rpartition('/')[0]
+            groups = self.rules.get(base)
+            if groups:
+                candidate = path[len(base) + 1:] if base else path
+                decision = self._decide(groups, candidate + suffix)
+                if decision is not None:
+                    return decision
+        return False
+
+    def is_path_ignored(self, relative_path, is_dir):
+        # Like is_ignored, but also true when any ancestor directory is ignored
+        parts = relative_path.split(os.sep)
+        for i in range(1, len(parts)):
+            if self.is_ignored(os.sep.join(parts[:i]), True):
+                return True
+        return self.is_ignored(relative_path, is_dir)
+
+class GitError(Exception):
+    pass
+
+def run_git(root, *args):
+    # NUL-separated paths from a git command run in root, as os.sep paths
+    try:
+        result = subprocess.run(['git', *args], cwd=root, capture_output=True)
+    except OSError as e:
+        raise GitError(f"git is not available: {str(e)}")
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', 'replace').strip()
+        raise GitError(message or f"git {args[0]} failed with exit code {result.returncode}")
+    return [os.path.normpath(os.fsdecode(path)) for path in result.stdout.split(b'\0') if path]
+
+def git_files(root, since=None, untracked=True):
+    # Paths under root, relative to it, as git sees them: everything in the
+    # index, or with since only what differs between that ref and the working
+    # tree (deletions left out). untracked adds new files .gitignore allows.
+    if since:
+        paths = run_git(root, 'diff', '--name-only', '-z', '--relative', '--diff-filter=d', since, '--')
+    else:
+        paths = run_git(root, 'ls-files', '-z', '--cached')
+    if untracked:
+        paths += run_git(root, 'ls-files', '-z', '--others', '--exclude-standard')
+    return sorted(set(paths))
+
+class FileEntry:
+    __slots__ = ('path', 'name', 'is_dir', 'size', 'mtime', 'children', 'loaded', 'sniffed')
+
+    def __init__(self, path, name, is_dir, size=0, mtime=0.0):
+        self.path = path  # Relative to the snapshot root, os.sep separated
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.children = [] if is_dir else None
+        self.loaded = not is_dir  # A directory's children have been scanned
+        self.sniffed = None  # Sniffed result once a file has been classified
+
+class DirectorySnapshot:
+    # In-memory picture of a folder built from os.scandir. The checkbox tree,
+    # the structure writer and combine_files all read from it instead of
+    # hitting the disk again. A lazy snapshot starts with the top level only;
+    # each directory is scanned the first time it is expanded or needed, and
+    # the result is kept.
+    def __init__(self, root, matcher=None, lazy=False, classify=False):
+        self.root = root
+        self.name = os.path.basename(os.path.normpath(root))
+        self.matcher = matcher
+        self.lazy = lazy
+        self.classify = classify  # Sniff files as they are scanned
+        self.top = []
+        self.entries = {}
+        self.errors = []
+
+    @classmethod
+    def scan(cls, root, matcher=None, lazy=False, classify=False):
+        snapshot = cls(root, matcher, lazy, classify)
+        snapshot.top = snapshot.list_dir("")
+        for entry in snapshot.top:
+            snapshot.entries[entry.path] = entry
+        if not lazy:
+            snapshot.load_subtree()
+        return snapshot
+
+    @classmethod
+    def from_paths(cls, root, paths, matcher=None, classify=False):
+        # A fully loaded snapshot of just the given files (relative to root),
+        # with their directories implied, instead of a walk. .gitignore files
+        # are not read: the paths are expected to come from git already.
+        snapshot = cls(root, matcher, classify=classify)
+        directories = {}
+
+        def directory(relative_dir):
+            if not relative_dir:
+                return snapshot.top
+            entry = directories.get(relative_dir)
+            if entry is None:
+                entry = FileEntry(relative_dir, os.path.basename(relative_dir), True)
+                entry.loaded = True
+                directories[relative_dir] = entry
+                snapshot.entries[relative_dir] = entry
+                directory(os.path.dirname(relative_dir)).append(entry)
+            return entry.children
+
+        for relative_path in paths:
+            if matcher is not None and matcher.is_path_ignored(relative_path, False):
+                continue
+            full_path = os.path.join(root, relative_path)
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                continue  # Deleted in the working tree but still in the index
+            except OSError as e:
+                snapshot.errors.append((full_path, str(e)))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                continue  # Submodules
+            entry = FileEntry(relative_path, os.path.basename(relative_path), False, st.st_size, st.st_mtime)
+            if classify:
+                try:
+                    entry.sniffed = classify_file(full_path, entry.name)
+                except OSError:
+                    pass
+            snapshot.entries[relative_path] = entry
+            directory(os.path.dirname(relative_path)).append(entry)
+
+        # Same order a walk would give
+        snapshot.top.sort(key=lambda entry: entry.name)
+        for entry in directories.values():
+            entry.children.sort(key=lambda child: child.name)
+        return snapshot
+
+    @classmethod
+    def from_git(cls, root, matcher=None, since=None, untracked=True, classify=False):
+        # Raises GitError if root is not in a git checkout or since is unknown
+        return cls.from_paths(root, git_files(root, since, untracked), matcher, classify)
+
+    def list_dir(self, relative_dir):
+        # Scan one directory level without touching the snapshot, so it is
+        # safe to run off the main thread; attach() stores the result
+        path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+        try:
+            with os.scandir(path) as it:
+                items = sorted(it, key=lambda item: item.name)
+        except OSError as e:
+            self.errors.append((path, str(e)))
+            return []
+
+        matcher = self.matcher
+        if matcher is not None and matcher.gitignore:
+            for item in items:
+                if item.name == '.gitignore':
+                    matcher.add_gitignore(item.path, relative_dir)
+                    break
+
+        children = []
+        for item in items:
+            relative_path = os.path.join(relative_dir, item.name) if relative_dir else item.name
+            try:
+                is_dir = item.is_dir()
+                # Ignored directories are decided once and never entered
+                if matcher is not None and matcher.is_ignored(relative_path, is_dir):
+                    continue
+                if is_dir:
+                    entry = FileEntry(relative_path, item.name, True)
+                else:
+                    st = item.stat()
+                    entry = FileEntry(relative_path, item.name, False, st.st_size, st.st_mtime)
+                    if self.classify:
+                        entry.sniffed = classify_file(item.path, item.name)
+            except OSError as e:
+                self.errors.append((item.path, str(e)))
+                continue
+            children.append(entry)
+        return children
+
+    def attach(self, relative_dir, children):
+        # Store a listing from list_dir() and return the directory's children.
+        # If it was loaded in the meantime the listing is dropped and the
+        # children already known are returned; nothing if it is gone.
+        entry = self.entries.get(relative_dir)
+        if entry is None or not entry.is_dir:
+            return []
+        if entry.loaded:
+            return entry.children
+        entry.children = children
+        entry.loaded = True
+        for child in children:
+            self.entries[child.path] = child
+        return children
+
+    def adopt(self, relative_dir, other):
+        # Attach relative_dir's listing from another snapshot of the same
+        # folder that has scanned it, instead of scanning again. Only this
+        # level is taken: subdirectories come unloaded and are adopted or
+        # listed in turn. Returns the children, or None if there was nothing
+        # to take (relative_dir unknown, already loaded, or not in other).
+        entry = self.entries.get(relative_dir)
+        source = other.get(relative_dir)
+        if entry is None or not entry.is_dir or entry.loaded or source is None or not source.loaded:
+            return None
+        matcher = self.matcher
+        children = []
+        for child in source.children:
+            if child.is_dir:
+                child = FileEntry(child.path, child.name, True)
+            elif child.name == '.gitignore' and matcher is not None and matcher.gitignore:
+                # What list_dir would have learned from this level
+                matcher.add_gitignore(os.path.join(self.root, child.path), relative_dir)
+            children.append(child)
+        return self.attach(relative_dir, children)
+
+    def load(self, relative_dir):
+        return self.attach(relative_dir, self.list_dir(relative_dir))
+
+    def load_subtree(self, relative_dir="", cancel=None):
+        # Make sure everything below relative_dir ("" for the whole snapshot)
+        # has been scanned
+        if relative_dir:
+            entry = self.entries.get(relative_dir)
+            if entry is None or not entry.is_dir:
+                return
+            stack = [entry]
+        else:
+            stack = list(self.top)
+        while stack:
+            entry = stack.pop()
+            if entry.is_dir:
+                if not entry.loaded:
+                    check_cancelled(cancel)
+                    self.load(entry.path)
+                stack.extend(entry.children)
+
+    def iter_subtree(self, relative_dir):
+        # Entries below relative_dir in walk order
+        entry = self.entries.get(relative_dir)
+        if entry is None or not entry.is_dir:
+            return iter(())
+        return (child for child, _ in self._walk_from(entry.children, 0))
+
+    def _siblings(self, relative_path):
+        # The list relative_path belongs in, or None if its parent is unknown,
+        # not a directory, or not scanned yet
+        parent = os.path.dirname(relative_path)
+        if not parent:
+            return self.top
+        parent_entry = self.entries.get(parent)
+        if parent_entry is None or not parent_entry.is_dir or not parent_entry.loaded:
+            return None
+        return parent_entry.children
+
+    def add(self, relative_path):
+        # Insert a path (and, for a directory, its whole subtree) that
+        # appeared after the scan. Returns the new entries in walk order.
+        existing = self.entries.get(relative_path)
+        if existing is not None:
+            if not existing.is_dir:
+                self.update(relative_path)
+            return []
+
+        parent = os.path.dirname(relative_path)
+        if parent and parent not in self.entries:
+            # Parent is not known yet either; adding it picks this path up too
+            return self.add(parent)
+        siblings = self._siblings(relative_path)
+        if siblings is None:
+            # Parent has not been scanned; it will see this path when it is
+            return []
+
+        full_path = os.path.join(self.root, relative_path)
+        name = os.path.basename(relative_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return []
+
+        if os.path.isdir(full_path):
+            entry = FileEntry(relative_path, name, True)
+        else:
+            entry = FileEntry(relative_path, name, False, st.st_size, st.st_mtime)
+            if self.classify:
+                try:
+                    entry.sniffed = classify_file(full_path, name)
+                except OSError:
+                    pass
+
+        position = bisect.bisect_left([sibling.name for sibling in siblings], name)
+        siblings.insert(position, entry)
+        self.entries[relative_path] = entry
+        if entry.is_dir and not self.lazy:
+            self.load_subtree(relative_path)
+        return [entry] + list(self.iter_subtree(relative_path))
+
+    def remove(self, relative_path):
+        # Drop a path and everything below it. Returns the removed entries.
+        entry = self.entries.get(relative_path)
+        if entry is None:
+            return []
+        siblings = self._siblings(relative_path)
+        if siblings is not None:
+            siblings.remove(entry)
+        removed = [entry]
+        if entry.is_dir:
+            removed.extend(self.iter_subtree(relative_path))
+        for item in removed:
+            self.entries.pop(item.path, None)
+        return removed
+
+    def update(self, relative_path):
+        entry = self.entries.get(relative_path)
+        if entry is None or entry.is_dir:
+            return
+        try:
+            st = os.stat(os.path.join(self.root, relative_path))
+        except OSError:
+            return
+        entry.size = st.st_size
+        entry.mtime = st.st_mtime
+        entry.sniffed = None
+        if self.classify:
+            try:
+                entry.sniffed = classify_file(os.path.join(self.root, relative_path), entry.name)
+            except OSError:
+                pass
+
+    def next_after(self, entry):
+        # First entry that follows entry's subtree in walk order, if any
+        relative_path = entry.path
+        while relative_path:
+            siblings = self._siblings(relative_path)
+            if siblings is not None:
+                index = siblings.index(self.entries[relative_path])
+                if index + 1 < len(siblings):
+                    return siblings[index + 1]
+            relative_path = os.path.dirname(relative_path)
+        return None
+
+    def get(self, relative_path):
+        return self.entries.get(relative_path)
+
+    def walk(self):
+        # Pre-order traversal yielding (entry, depth) without recursion
+        return self._walk_from(self.top, 0)
+
+    @staticmethod
+    def _walk_from(entries, depth):
+        stack = [(entry, depth) for entry in reversed(entries)]
+        while stack:
+            entry, depth = stack.pop()
+            yield entry, depth
+            if entry.is_dir:
+                stack.extend((child, depth + 1) for child in reversed(entry.children))
+
+class CollationOptions:
+    # Settings for one collation run. The GUI fills these in from its widgets,
+    # the CLI from flags and an optional JSON config file.
+    def __init__(self, remove_comments=False, size_limit=DEFAULT_SIZE_LIMIT, parallel=False, workers=None,
+                 batch_size=DEFAULT_BATCH_SIZE, cache_path=None, files_to_ignore=FILES_TO_IGNORE,
+                 chunk_bytes=0, chunk_tokens=0, output_format='txt', non_text='summary', incremental=False,
+                 dedup=False, prefetch=0, prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+        self.remove_comments = remove_comments
+        self.size_limit = size_limit  # Bytes, 0 for no limit
+        self.parallel = parallel
+        self.workers = workers  # None uses every core
+        self.batch_size = batch_size
+        self.cache_path = cache_path  # None disables the result cache
+        self.files_to_ignore = files_to_ignore
+        # Split the content file into parts under this budget; 0 for one file
+        self.chunk_bytes = chunk_bytes
+        self.chunk_tokens = chunk_tokens
+        # 'txt' (optionally chunked), or 'gzip' / 'jsonl' with an index
+        self.output_format = output_format
+        # Binary and generated files: 'summary' writes a one-line note, 'skip'
+        # leaves them out entirely, 'include' reads them like any other file
+        self.non_text = non_text
+        # Rebuild a flat output from its previous version where files are unchanged
+        self.incremental = incremental
+        # Write later copies of identical files as a reference to the first
+        self.dedup = dedup
+        # Files read ahead on threads in serial mode (0 = off), and the
+        # bytes those reads may hold at once
+        self.prefetch = prefetch
+        self.prefetch_bytes = prefetch_bytes
+
+    @property
+    def chunked(self):
+        return self.output_format == 'txt' and bool(self.chunk_bytes or self.chunk_tokens)
+
+class CollationCancelled(Exception):
+    pass
+
+def check_cancelled(cancel):
+    # cancel is anything with is_set(), normally a threading.Event
+    if cancel is not None and cancel.is_set():
+        raise CollationCancelled()
+
+def format_size(num_bytes):
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+class ProgressUpdate(namedtuple('ProgressUpdate',
+                                'stage files_done files_total bytes_done bytes_total current elapsed')):
+    __slots__ = ()
+
+    @property
+    def files_per_second(self):
+        return self.files_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def describe(self):
+        return (f"{self.files_done}/{self.files_total} files, "
+                f"{self.files_per_second:.0f} files/s, {format_size(self.bytes_per_second)}/s")
+
+class ProgressTracker:
+    # Reports at most once per interval so a fast loop over small files does
+    # not flood whoever is listening (the GUI pushes each update through a queue)
+    def __init__(self, stage, files_total, bytes_total, callback, interval=0.1):
+        self.stage = stage
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.callback = callback
+        self.interval = interval
+        self.files_done = 0
+        self.bytes_done = 0
+        self.started = time.perf_counter()
+        self.last_report = 0.0
+
+    def advance(self, current, num_bytes=0):
+        self.files_done += 1
+        self.bytes_done += num_bytes
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.files_done == self.files_total:
+            self.last_report = now
+            self.callback(ProgressUpdate(self.stage, self.files_done, self.files_total, self.bytes_done,
+                                         self.bytes_total, current, now - self.started))
+
+class Instrumentation:
+    # Optional hooks around the pipeline stages, passed to collate as metrics.
+    # Stage times are summed over files (and over worker processes, so they
+    # can add up to more than the wall time). Files are memory-mapped, so page
+    # faults land in 'decode' rather than 'read'; stripping and counting are
+    # one lexer pass, booked as 'strip' or 'count' depending on the run.
+    # With metrics=None none of this is reached from the per-file loop.
+    STAGES = ('walk', 'filter', 'read', 'decode', 'strip', 'count', 'write')
+
+    def __init__(self, slowest=10, profile=False):
+        self.stages = {name: {'seconds': 0.0, 'files': 0, 'bytes': 0} for name in self.STAGES}
+        self.cache_hits = 0
+        self.cache_lookups = 0
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.wall = 0.0
+        self.started = None
+        self.slowest_limit = slowest
+        self.slowest = []  # Min-heap of (seconds, path)
+        self.profile = profile
+        self.profiler = None
+        self.profile_rows = []
+
+    def add(self, stage, seconds, files=0, num_bytes=0):
+        totals = self.stages[stage]
+        totals['seconds'] += seconds
+        totals['files'] += files
+        totals['bytes'] += num_bytes
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def timed_listing(self, matcher, build):
+        # Runs build(matcher) -> DirectorySnapshot with the time booked under
+        # 'walk' and the ignore checks under 'filter'. A listing is taken
+        # before collate is called, so this starts the clock for the wall time.
+        self.start()
+        timed = TimedMatcher(matcher, self) if matcher is not None else None
+        with self.stage('walk'):
+            snapshot = build(timed)
+        snapshot.matcher = matcher
+        return snapshot
+
+    def seconds(self, *stages):
+        return sum(self.stages[stage]['seconds'] for stage in stages)
+
+    def timed_chunks(self, chunks):
+        # Books the time spent producing each decoded chunk under 'decode'
+        stage = self.stages['decode']
+        stage['files'] += 1
+        iterator = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                stage['seconds'] += time.perf_counter() - started
+                return
+            stage['seconds'] += time.perf_counter() - started
+            yield chunk
+
+    def file_done(self, path, seconds, num_bytes):
+        self.files += 1
+        self.bytes_read += num_bytes
+        if len(self.slowest) < self.slowest_limit:
+            heapq.heappush(self.slowest, (seconds, path))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, path))
+
+    def start(self):
+        if self.started is not None:
+            return  # Already running, since the listing was taken
+        self.started = time.perf_counter()
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            import pstats
+            stats = pstats.Stats(self.profiler)
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:30]
+            self.profile_rows = [{'function': f"{os.path.basename(filename)}:{line}({name})", 'calls': calls,
+                                  'tottime': round(tottime, 6), 'cumtime': round(cumtime, 6)}
+                                 for (filename, line, name), (_, calls, tottime, cumtime, _) in rows]
+        self.wall = time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {
+            'wall_seconds': round(self.wall, 6),
+            'files': self.files,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'cache': {'hits': self.cache_hits, 'lookups': self.cache_lookups},
+            'stages': {name: dict(totals, seconds=round(totals['seconds'], 6))
+                       for name, totals in self.stages.items()},
+            'slowest_files': [{'path': path, 'seconds': round(seconds, 6)}
+                              for seconds, path in sorted(self.slowest, reverse=True)],
+            'profile': self.profile_rows,
+        }
+
+    def report_lines(self):
+        lines = [f"Metrics: {self.wall:.3f} s wall, {self.files} files, {format_size(self.bytes_read)} read, "
+                 f"{format_size(self.bytes_written)} written, {self.cache_hits}/{self.cache_lookups} cache hits"]
+        for name, totals in self.stages.items():
+            if not totals['seconds'] and not totals['files']:
+                continue
+            line = f"  {name:<7} {totals['seconds']:8.3f} s"
+            if totals['files']:
+                line += f"  {totals['files']} files"
+            if totals['bytes'] and totals['seconds'] > 0:
+                line += f"  {format_size(totals['bytes'] / totals['seconds'])}/s"
+            lines.append(line)
+        if self.slowest:
+            lines.append("Slowest files:")
+            lines.extend(f"  {seconds:8.3f} s  {path}" for seconds, path in sorted(self.slowest, reverse=True))
+        if self.profile_rows:
+            lines.append("Profile (top 10 by cumulative time):")
+            lines.extend(f"  {row['cumtime']:8.3f} s  {row['calls']:>8}  {row['function']}"
+                         for row in self.profile_rows[:10])
+        return lines
+
+    def write(self, metrics_file):
+        with open(metrics_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(os.path.dirname(metrics_file), PROFILE_FILE_NAME))
+
+class TimedMatcher:
+    # Stands in for a snapshot's IgnoreMatcher while metrics are collected
+    def __init__(self, matcher, metrics):
+        self.matcher = matcher
+        self.metrics = metrics
+
+    def is_ignored(self, relative_path, is_dir):
+        started = time.perf_counter()
+        try:
+            return self.matcher.is_ignored(relative_path, is_dir)
+        finally:
+            self.metrics.add('filter', time.perf_counter() - started, 1)
+
+    def is_path_ignored(self, relative_path, is_dir):
+        # Listings from git check whole paths
+        started = time.perf_counter()
+        try:
+            return self.matcher.is_path_ignored(relative_path, is_dir)
+        finally:
+            self.metrics.add('filter', time.perf_counter() - started, 1)
+
+    def __getattr__(self, name):
+        return getattr(self.matcher, name)
+
+class TimedOutput:
+    # Wraps a content output so every write is booked under 'write'
+    def __init__(self, output, metrics):
+        self.output = output
+        self.stage = metrics.stages['write']
+
+    def write(self, text):
+        started = time.perf_counter()
+        result = self.output.write(text)
+        self.stage['seconds'] += time.perf_counter() - started
+        return result
+
+    def begin_file(self, relative_path, dir_path, header, estimate):
+        started = time.perf_counter()
+        self.output.begin_file(relative_path, dir_path, header, estimate)
+        self.stage['seconds'] += time.perf_counter() - started
+
+    def end_file(self, line_count, trailer, reusable=True, digest=None):
+        started = time.perf_counter()
+        self.output.end_file(line_count, trailer, reusable, digest)
+        self.stage['seconds'] += time.perf_counter() - started
+        self.stage['files'] += 1
+
+def _no_log(message):
+    pass
+
+def generate_tree(snapshot, output_file, cancel=None):
+    # Iterative so deep trees cannot hit the recursion limit; lines are
+    # written as they are visited rather than built up in memory
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(f"├── {snapshot.name}\n")
+        for count, (entry, depth) in enumerate(snapshot.walk()):
+            if count % 1024 == 0:
+                check_cancelled(cancel)
+            f.write(f"{'│   ' * (depth + 1)}├── {entry.name}\n")
+
+def write_file_content(out, entry, file_path, remove_comments_enabled, cache=None, cached=None, settings=None,
+                       metrics=None, data=None):
+    # Streams one file into out and returns its non-comment line count and
+    # the digest of its bytes. A cached result skips the lexer, and with
+    # comments removed (or no content wanted at all) it skips reading the
+    # file; the digest then comes from the cache. data is the file's
+    # contents when they have been read ahead.
+    if cached is not None and isinstance(out, NullOutput):
+        return cached.line_count, cached.digest
+    if cached is not None and remove_comments_enabled:
+        out.write(cached.content)
+        return cached.line_count, cached.digest
+
+    file_extension = os.path.splitext(file_path)[1]
+    settings = settings or ('strip' if remove_comments_enabled else 'count')
+    started = time.perf_counter() if metrics is not None else 0.0
+    with SourceFile(file_path, data) as source:
+        # Hashing the buffer already read costs no extra I/O
+        digest = cached.digest if cached is not None and cached.digest else source.digest()
+        if cache is not None and cached is None:
+            cached = cache.lookup_digest(file_path, digest, settings, entry.size, entry.mtime)
+            if metrics is not None and cached is not None:
+                metrics.cache_hits += 1
+            if cached is not None and remove_comments_enabled:
+                out.write(cached.content)
+                return cached.line_count, digest
+
+        if metrics is not None:
+            metrics.add('read', time.perf_counter() - started, 1, entry.size)
+            started = time.perf_counter()
+        # The encoding check runs here, before the first chunk
+        chunks = source.iter_text()
+        if metrics is not None:
+            metrics.add('decode', time.perf_counter() - started)
+            chunks = metrics.timed_chunks(chunks)
+        if cached is not None:
+            for chunk in chunks:
+                out.write(chunk)
+            return cached.line_count, digest
+
+        if not remove_comments_enabled:
+            line_count = scan_source(iter_lines(chunks, out.write), file_extension)
+            stripped = None
+        else:
+            kept = []
+            separator = ''
+            def keep(line):
+                nonlocal separator
+                out.write(separator)
+                out.write(line)
+                separator = '\n'
+                if cache is not None:
+                    kept.append(line)
+            line_count = scan_source(iter_lines(chunks), file_extension, keep)
+            stripped = '\n'.join(kept) if cache is not None else None
+
+    if cache is not None:
+        cache.store(file_path, entry.size, entry.mtime, settings, digest, line_count, stripped)
+    return line_count, digest
+
+def open_result_cache(cache_path, log=_no_log):
+    if not cache_path:
+        return None
+    try:
+        return ResultCache(cache_path)
+    except sqlite3.Error as e:
+        log(f"Result cache unavailable: {str(e)}")
+        return None
+
+def combine_files(snapshot, selected_files, output_file=None, options=None, log=_no_log, progress=None,
+                  cancel=None, metrics=None):
+    # With no output_file only the line counts are produced; nothing is
+    # written to disk and comments are not stripped (counts are the same).
+    # progress receives ProgressUpdates; setting cancel stops between files
+    # with CollationCancelled; metrics is an optional Instrumentation.
+    options = options or CollationOptions()
+    line_counts = {}
+    remove_comments_enabled = options.remove_comments and output_file is not None
+    size_limit = options.size_limit
+
+    preamble = "Comments have been removed from the source files\n" if remove_comments_enabled else ""
+    with open_content_output(output_file, options, preamble, snapshot.root) as output:
+        f = output if metrics is None or isinstance(output, NullOutput) else TimedOutput(output, metrics)
+        selected_files = sorted(selected_files, key=lambda x: x.count(os.sep))
+        entries = []
+        for relative_path in selected_files:
+            # Skip directory entries that are shown in square brackets in the UI
+            if relative_path.startswith('[') and relative_path.endswith(']'):
+                continue
+
+            entry = snapshot.get(relative_path)
+
+            # Skip if it's a directory or ignored file
+            if (entry is None or entry.is_dir or entry.name in options.files_to_ignore
+                    or GENERATED_OUTPUT_RE.match(entry.name)):
+                continue
+            entries.append(entry)
+
+        # Binary and generated files are recognised from their name or their
+        # first SNIFF_SIZE bytes and never decoded
+        sniff = options.non_text != 'include'
+        def is_non_text(entry):
+            if sniff and entry.sniffed is None:
+                entry.sniffed = sniff_name(entry.name)
+            return sniff and entry.sniffed is not None and entry.sniffed.kind in NON_TEXT_KINDS
+
+        # Files read in include mode get their own cache entries, so a binary
+        # cached then is never served as text to a sniffing run
+        lexer_stage = 'strip' if remove_comments_enabled else 'count'
+        settings = lexer_stage + ('' if sniff else '-all')
+        # The listing can be older than the files (edits while the folder was
+        # not watched, network mounts), so the previous output and the cache
+        # are checked against the files as they are now. Each file is stat'ed
+        # once, on the read-ahead threads when there are any, and its entry
+        # takes the fresh size and mtime.
+        current = set()
+        if options.cache_path or isinstance(output, IncrementalOutput):
+            file_paths = [os.path.join(snapshot.root, entry.path) for entry in entries]
+            for entry, st in zip(entries, stat_files(file_paths, options.prefetch)):
+                if st is not None:
+                    entry.size, entry.mtime = st.st_size, st.st_mtime
+                    current.add(entry.path)
+        # Unchanged files' sections are copied from the previous output
+        unchanged = {}
+        if isinstance(output, IncrementalOutput):
+            for entry in entries:
+                if entry.path not in current:
+                    continue
+                section = output.unchanged(entry)
+                if section is not None:
+                    unchanged[entry.path] = section
+        eligible = [entry for entry in entries if not (size_limit and entry.size > size_limit or is_non_text(entry))]
+        # Copies are found as files are read, without a pass of their own
+        same_as = {}
+        duplicates = DuplicateTracker(eligible) if options.dedup else None
+        readable = [entry for entry in eligible if entry.path not in unchanged]
+        tracker = None
+        if progress is not None:
+            tracker = ProgressTracker('content' if output_file else 'counts', len(entries),
+                                      sum(entry.size for entry in readable), progress)
+        cache = open_result_cache(options.cache_path, log)
+        results = None
+        reads = None
+        pooled = set()
+        try:
+            cached = {}
+            if cache is not None:
+                for entry in readable:
+                    if entry.path not in current:
+                        continue  # Reported when the file is read
+                    hit = cache.lookup(os.path.join(snapshot.root, entry.path), entry.size, entry.mtime, settings)
+                    if hit is not None:
+                        cached[entry.path] = hit
+                if metrics is not None:
+                    metrics.cache_lookups += len(readable)
+                    metrics.cache_hits += len(cached)
+
+            if options.parallel:
+                # Workers only see files that will actually be read; results
+                # come back in this same order so the output matches serial mode
+                pooled = {entry.path for entry in readable if entry.path not in cached}
+                file_paths = [os.path.join(snapshot.root, entry.path) for entry in readable if entry.path in pooled]
+                results = iter_parallel_results(file_paths, remove_comments_enabled, options.workers,
+                                                options.batch_size, sniff, metrics is not None)
+            if options.prefetch:
+                # Files this process reads itself are read ahead on threads,
+                # hiding per-file latency; cached stripped content needs no read
+                content_cached = remove_comments_enabled or isinstance(output, NullOutput)
+                prefetched = [entry for entry in readable if entry.path not in pooled
+                              and not (entry.path in cached and content_cached)]
+                reads = iter_prefetched([os.path.join(snapshot.root, entry.path) for entry in prefetched],
+                                        [entry.size for entry in prefetched], options.prefetch,
+                                        options.prefetch_bytes)
+                prefetched = {entry.path for entry in prefetched}
+
+            current_dir = None
+            for entry in entries:
+                check_cancelled(cancel)
+                relative_path = entry.path
+                file_path = os.path.join(snapshot.root, relative_path)
+
+                if metrics is not None:
+                    file_started = time.perf_counter()
+                    before = metrics.seconds('read', 'decode', 'write')
+                if relative_path in unchanged:
+                    section = unchanged[relative_path]
+                    original = None
+                    if duplicates is not None and relative_path in duplicates.candidates:
+                        original = duplicates.original(relative_path, section['hash'])
+                    if original is None:
+                        dir_path = os.path.dirname(relative_path)
+                        line_counts[relative_path] = output.copy_section(
+                            entry, section, directory_header(dir_path) if dir_path and dir_path != current_dir else '')
+                        current_dir = dir_path
+                        if metrics is not None:
+                            elapsed = time.perf_counter() - file_started
+                            metrics.add('write', elapsed)
+                            metrics.file_done(relative_path, elapsed, 0)
+                        if tracker is not None:
+                            tracker.advance(relative_path, 0)
+                        continue
+                    # Its reference may point somewhere new
+                    same_as[relative_path] = original
+                too_large = size_limit and entry.size > size_limit
+                data = read_error = None
+                if reads is not None and relative_path in prefetched:
+                    waited = time.perf_counter()
+                    data, read_error = next(reads)
+                    if metrics is not None:
+                        metrics.add('read', time.perf_counter() - waited)
+                result = None
+                # A possible copy needs its digest before its header is written
+                candidate = (duplicates is not None and relative_path in duplicates.candidates
+                             and relative_path not in same_as)
+                digest = None
+                read_started = time.perf_counter() if metrics is not None else 0.0
+                if results is not None and relative_path in pooled:
+                    result = next(results)
+                    digest = result[3]
+                    if sniff and result[4] is not None:
+                        entry.sniffed = result[4]
+                elif candidate and relative_path in cached and cached[relative_path].digest:
+                    digest = cached[relative_path].digest
+                elif candidate:
+                    # Read here rather than below; the same bytes are sniffed
+                    # and collated
+                    if data is None and read_error is None:
+                        try:
+                            data = read_file(file_path)
+                        except OSError as e:
+                            read_error = e
+                    if data is not None:
+                        digest = content_digest(data)
+                if (result is None and sniff and entry.sniffed is None and not too_large
+                        and relative_path not in cached and relative_path not in same_as):
+                    try:
+                        entry.sniffed = classify_file(file_path, entry.name, data)
+                    except OSError:
+                        pass  # Reported when the file is read below
+                if metrics is not None and result is None:
+                    metrics.add('read', time.perf_counter() - read_started)
+                non_text = not too_large and is_non_text(entry)
+                if candidate and not non_text:
+                    original = duplicates.original(relative_path, digest)
+                    if original is not None:
+                        same_as[relative_path] = original
+                # Files noted in a line rather than read
+                stub = too_large or non_text or relative_path in same_as
+                if non_text and options.non_text == 'skip':
+                    if tracker is not None:
+                        tracker.advance(relative_path)
+                    continue
+
+                dir_path = os.path.dirname(relative_path)
+                header = directory_header(dir_path) if dir_path and dir_path != current_dir else ''
+                header += file_header(relative_path)
+                f.begin_file(relative_path, dir_path, header, 64 if stub else entry.size)
+                current_dir = dir_path
+
+                failed = False
+                digest = None
+                try:
+                    if too_large:
+                        f.write("File too large to include in combined output\n")
+                        line_counts[relative_path] = 0
+                    elif non_text:
+                        f.write(describe_non_text(entry.sniffed, entry.size))
+                        line_counts[relative_path] = 0
+                    elif relative_path in same_as:
+                        f.write(f"Same as {same_as[relative_path]}\n")
+                        line_counts[relative_path] = line_counts[same_as[relative_path]]
+                    elif result is not None:
+                        content, line_count, error, digest, _, timings = result
+                        if timings is not None:
+                            metrics.add('read', timings[0], 1, entry.size)
+                            metrics.add('decode', timings[1], 1)
+                            metrics.add(lexer_stage, timings[2], 1)
+                        if error is not None:
+                            raise OSError(error)
+                        f.write(content)
+                        line_counts[relative_path] = line_count
+                        if cache is not None:
+                            cache.store(file_path, entry.size, entry.mtime, settings, digest, line_count,
+                                        content if remove_comments_enabled else None)
+                    else:
+                        if read_error is not None:
+                            raise read_error
+                        line_counts[relative_path], digest = write_file_content(
+                            f, entry, file_path, remove_comments_enabled, cache, cached.get(relative_path), settings,
+                            metrics, data)
+                except Exception as e:
+                    f.write(f"Error reading file: {str(e)}\n")
+                    line_counts[relative_path] = 0
+                    failed = True
+
+                f.end_file(line_counts[relative_path], "\n\n", not failed and relative_path not in same_as, digest)
+                if metrics is not None:
+                    elapsed = time.perf_counter() - file_started
+                    if result is None and not (stub or relative_path in cached):
+                        # Whatever reading, decoding and writing did not take was the lexer
+                        lexed = elapsed - (metrics.seconds('read', 'decode', 'write') - before)
+                        metrics.add(lexer_stage, max(0.0, lexed), 1)
+                    metrics.file_done(relative_path, elapsed, 0 if stub else entry.size)
+                if tracker is not None:
+                    tracker.advance(relative_path, 0 if stub else entry.size)
+        finally:
+            if results is not None:
+                results.close()
+            if reads is not None:
+                reads.close()
+            if cache is not None:
+                cache.close()
+
+    if isinstance(output, ChunkedOutput):
+        log(f"Split content into {len(output.parts)} parts")
+    if same_as:
+        log(f"Deduplicated {len(same_as)} identical files")
+    if isinstance(output, IncrementalOutput):
+        log(f"Reused {output.reused} of {len(output.sections)} sections from the previous output")
+    if metrics is not None:
+        metrics.bytes_written += sum(os.path.getsize(path) for path in output.paths if os.path.exists(path))
+
+    return line_counts
+
+def generate_line_counts_file(line_counts, counts_file):
+    total_lines = sum(line_counts.values())
+    with open(counts_file, 'w', encoding='utf-8') as f:
+        f.write(f"Total lines of code: {total_lines}\n\n")
+        f.write("Line counts per file:\n")
+        for file_path, count in line_counts.items():
+            f.write(f"{file_path}: {count}\n")
+
+def resolve_selection(snapshot, selected_files, cancel=None):
+    # A selected directory stands for everything below it, but the tree only
+    # lists the rows it has drawn, and the snapshot may have been scanned
+    # further than that (by an earlier save, say). Scan each one and select
+    # what it holds, keeping walk order.
+    resolved = []
+    seen = set()
+    for path in selected_files:
+        if path in seen:
+            continue
+        seen.add(path)
+        resolved.append(path)
+        entry = snapshot.get(path)
+        if entry is not None and entry.is_dir:
+            snapshot.load_subtree(path, cancel)
+            for child in snapshot.iter_subtree(path):
+                if child.path not in seen:
+                    seen.add(child.path)
+                    resolved.append(child.path)
+    return resolved
+
+def select_by_rules(snapshot, rules):
+    # Paths that (path, included) rules select from a fully loaded snapshot,
+    # in walk order. A path follows the nearest rule on it or above it and
+    # nothing is selected without one.
+    rules = dict(rules)
+    selected = []
+    stack = [(entry, False) for entry in reversed(snapshot.top)]
+    while stack:
+        entry, included = stack.pop()
+        included = rules.get(entry.path, included)
+        if included:
+            selected.append(entry.path)
+        if entry.is_dir:
+            stack.extend((child, included) for child in reversed(entry.children))
+    return selected
+
+class SelectionProfiles:
+    # Named selections kept in a JSON file. A selection is saved as the few
+    # rules it takes to rebuild it ("+dir" selects a subtree, "-dir/file"
+    # takes part of it back out, see select_by_rules) rather than as every
+    # checked path. Files added since a profile was saved follow the rule
+    # of their directory, and rules for paths that are gone go unused.
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.profiles = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.profiles = data['profiles']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass  # Missing or unreadable; starts empty
+
+    def names(self):
+        return sorted(self.profiles)
+
+    def rules(self, name):
+        # (path, included) pairs, or None for an unknown profile
+        profile = self.profiles.get(name)
+        if profile is None:
+            return None
+        return [(rule[1:].replace('/', os.sep), rule[0] == '+') for rule in profile['rules']]
+
+    def save(self, name, folder, rules):
+        self.profiles[name] = {
+            'folder': folder,
+            'saved': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'rules': [('+' if included else '-') + path.replace(os.sep, '/') for path, included in rules],
+        }
+        self._write()
+
+    def delete(self, name):
+        if self.profiles.pop(name, None) is not None:
+            self._write()
+
+    def _write(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'profiles': self.profiles}, f, indent=1)
+        os.replace(temp_path, self.path)
+
+class PathIndex:
+    # Search over every path of a listing, for the tree's filter box. Paths
+    # are kept in walk order and folded to lower case, with / separators and
+    # a trailing / on directories. Substring queries scan that array. A
+    # per-character index records which paths contain each character. Glob
+    # queries use ignore-pattern syntax and are first narrowed, through the
+    # index, to the paths holding their longest literal part. Fuzzy queries
+    # (the characters in order, anything in between) are narrowed by the
+    # index, which alone answers a single character. A query that extends
+    # the previous one only rechecks the previous matches. Building the index
+    # for 200k paths takes a fraction of a second, so callers build it off
+    # the UI thread.
+    MODES = ('substring', 'glob', 'fuzzy')
+
+    def __init__(self, entries):
+        # entries: (path, is_dir) pairs in display order
+        self.paths = []
+        self.folded = []
+        for path, is_dir in entries:
+            self.paths.append(path)
+            self.folded.append(path.replace(os.sep, '/').lower() + ('/' if is_dir else ''))
+        # Character -> int with one byte per path, 1 where the path contains it
+        self.char_masks = {}
+        for char in set().union(*self.folded):
+            self.char_masks[char] = int.from_bytes(bytes([char in path for path in self.folded]), 'big')
+        self.last = None  # (mode, query, ids) of the previous search
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls((entry.path, entry.is_dir) for entry, _ in snapshot.walk())
+
+    def __len__(self):
+        return len(self.paths)
+
+    def search(self, query, mode='substring'):
+        # Ids (indexes into paths) of the matching paths, in order
+        query = query.strip().lower()
+        if not query:
+            return list(range(len(self.paths)))
+        folded = self.folded
+        last = self.last
+        candidates = None
+        if last is not None and last[0] == mode and (
+                last[1] in query if mode == 'substring' else mode == 'fuzzy' and query.startswith(last[1])):
+            candidates = last[2]
+
+        if mode == 'substring':
+            if candidates is None:
+                ids = [i for i, path in enumerate(folded) if query in path]
+            else:
+                ids = [i for i in candidates if query in folded[i]]
+        elif mode == 'glob':
+            translated = IgnoreMatcher._translate(query)
+            if translated is None:
+                return []
+            pattern = re.compile(translated[0])
+            literals = re.split(r'\[[^\]]*\]|[*?\\]', query.lstrip('!'))
+            literal = max((part.strip('/') for part in literals), key=len)
+            if literal:
+                present = itertools.compress(range(len(folded)), self._containing(set(literal)))
+                candidates = [i for i in present if literal in folded[i]]
+            else:
+                candidates = range(len(folded))
+            ids = [i for i in candidates if pattern.fullmatch(folded[i])]
+        elif mode == 'fuzzy':
+            present = self._containing(set(query))
+            if candidates is None:
+                candidates = itertools.compress(range(len(folded)), present)
+            else:
+                candidates = [i for i in candidates if present[i]]
+            if len(query) == 1:
+                ids = list(candidates)
+            else:
+                # "[^c]*c" for each character: every star stops at the first
+                # occurrence, so a path that fails does so in one linear pass
+                # instead of backtracking through every way to place the query
+                match = re.compile(''.join(f'[^{char}]*{char}' for char in map(re.escape, query))).match
+                ids = [i for i in candidates if match(folded[i])]
+        else:
+            raise ValueError(f"unknown search mode: {mode}")
+        self.last = (mode, query, ids)
+        return ids
+
+    def _containing(self, chars):
+        # One byte per path, 1 where the path contains every one of chars
+        combined = -1
+        for char in chars:
+            combined &= self.char_masks.get(char, 0)
+        return combined.to_bytes(len(self.folded), 'big')
+
+def collate(snapshot, selected_files, structure_file=None, content_file=None, counts_file=None,
+            options=None, log=_no_log, progress=None, cancel=None, metrics=None):
+    # One job for any combination of outputs: the structure comes from the
+    # snapshot and every selected file is read once for content and counts.
+    # A cancelled job removes the outputs it had started and re-raises (the
+    # content outputs clean up after themselves). With metrics, the stage
+    # report goes to log and METRICS_FILE_NAME is written next to the outputs.
+    options = options or CollationOptions()
+    if metrics is None:
+        return _collate(snapshot, selected_files, structure_file, content_file, counts_file, options, log,
+                        progress, cancel)
+
+    matcher = snapshot.matcher
+    if matcher is not None:
+        snapshot.matcher = TimedMatcher(matcher, metrics)
+    metrics.start()
+    try:
+        line_counts = _collate(snapshot, selected_files, structure_file, content_file, counts_file, options, log,
+                               progress, cancel, metrics)
+    finally:
+        metrics.stop()
+        snapshot.matcher = matcher
+    for path in (structure_file, counts_file):
+        if path:
+            metrics.bytes_written += os.path.getsize(path)
+    for line in metrics.report_lines():
+        log(line)
+    metrics_file = os.path.join(os.path.dirname(counts_file or content_file or structure_file or ''),
+                                METRICS_FILE_NAME)
+    metrics.write(metrics_file)
+    log(f"Generated metrics file: {metrics_file}")
+    return line_counts
+
+def _collate(snapshot, selected_files, structure_file, content_file, counts_file, options, log, progress, cancel,
+             metrics=None):
+    walk = metrics.stage('walk') if metrics is not None else nullcontext()
+    try:
+        if structure_file:
+            with walk:
+                snapshot.load_subtree(cancel=cancel)
+            generate_tree(snapshot, structure_file, cancel)
+            log(f"Generated structure file: {structure_file}")
+    except CollationCancelled:
+        _remove_files([structure_file])
+        raise
+
+    line_counts = None
+    if content_file or counts_file:
+        walk = metrics.stage('walk') if metrics is not None else nullcontext()
+        with walk:
+            selected_files = resolve_selection(snapshot, selected_files, cancel)
+        line_counts = combine_files(snapshot, selected_files, content_file, options, log, progress, cancel,
+                                    metrics)
+        if content_file and options.chunked:
+            log(f"Generated content manifest: {ChunkedOutput.manifest_path(content_file)}")
+        elif content_file:
+            log(f"Generated content file: {content_file}")
+            if options.output_format != 'txt':
+                log(f"Generated content index: {IndexedOutput.index_path(content_file)}")
+        if counts_file:
+            generate_line_counts_file(line_counts, counts_file)
+            log(f"Generated line counts file: {counts_file}")
+    return line_counts
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Collate a folder's structure, file contents and line counts without the GUI.")
+    parser.add_argument('folder', nargs='?', help="folder to collate")
+    parser.add_argument('--config', help="JSON file whose keys provide defaults for the options below")
+    parser.add_argument('--structure', action='store_true', help="write file_structure.txt")
+    parser.add_argument('--content', action='store_true', help="write combined_output.txt")
+    parser.add_argument('--counts', action='store_true', help="write line_counts.txt")
+    parser.add_argument('-o', '--output-dir', default=os.curdir, help="where to write the outputs")
+    parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                        help="extra gitignore-style pattern; may be repeated")
+    parser.add_argument('--no-default-ignores', action='store_true', help="do not apply the built-in ignores")
+    parser.add_argument('--no-gitignore', action='store_true', help="do not read .gitignore files")
+    parser.add_argument('--git', action='store_true',
+                        help="list files from the git index (plus untracked, unignored files) instead of walking")
+    parser.add_argument('--since', metavar='REF', help="only collate files changed since this git ref (implies --git)")
+    parser.add_argument('--no-untracked', action='store_true', help="with --git/--since, leave out untracked files")
+    parser.add_argument('--selection', metavar='NAME', help="only collate what this saved selection profile selects")
+    parser.add_argument('--selections', metavar='FILE',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), PROFILES_FILE_NAME),
+                        help="selection profiles file (default: the one the GUI saves to)")
+    parser.add_argument('--remove-comments', action='store_true', help="strip comments from the contents")
+    parser.add_argument('--max-file-size', type=int, default=DEFAULT_SIZE_LIMIT // 1024, metavar='KB',
+                        help="skip larger files (0 = no limit)")
+    parser.add_argument('--parallel', action='store_true', help="collate on a process pool")
+    parser.add_argument('--workers', type=int, default=0, help="pool size (0 = one per core)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="files per worker task")
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help="read up to N files ahead on threads, for slow or network filesystems (0 = off)")
+    parser.add_argument('--prefetch-mb', type=int, default=DEFAULT_PREFETCH_BYTES // (1024 * 1024), metavar='MB',
+                        help="most read-ahead data held at once")
+    parser.add_argument('--cache', metavar='FILE', help="result cache database to use")
+    parser.add_argument('--non-text', choices=('summary', 'skip', 'include'), default='summary',
+                        help="binary and generated files: note them, leave them out, or read them anyway")
+    parser.add_argument('--format', choices=sorted(CONTENT_FILE_NAMES), default='txt',
+                        help="content format: flat text, or gzip/jsonl with a sidecar index")
+    parser.add_argument('--incremental', action='store_true',
+                        help="rebuild combined_output.txt from its previous version, re-reading only changed files")
+    parser.add_argument('--dedup', action='store_true',
+                        help="write later copies of identical files as a reference to the first")
+    chunking = parser.add_mutually_exclusive_group()
+    chunking.add_argument('--chunk-kb', type=int, default=0, metavar='KB',
+                          help="split the contents into parts of at most this size")
+    chunking.add_argument('--chunk-tokens', type=int, default=0, metavar='N',
+                          help="split the contents into parts of roughly this many tokens")
+    parser.add_argument('--progress', action='store_true', help="report progress on stderr")
+    parser.add_argument('--metrics', action='store_true',
+                        help=f"report per-stage timings and write {METRICS_FILE_NAME} next to the outputs")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"like --metrics, and also profile the run into {PROFILE_FILE_NAME}")
+    return parser
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        try:
+            with open(args.config, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read config {args.config}: {str(e)}")
+        # Config values become defaults, so explicit flags still win
+        defaults = {key.replace('-', '_'): value for key, value in config.items()}
+        if isinstance(defaults.get('ignore'), str):
+            defaults['ignore'] = [defaults['ignore']]
+        parser.set_defaults(**defaults)
+        args = parser.parse_args(argv)
+    if not args.folder:
+        parser.error("a folder is required (as an argument or in the config file)")
+    if not os.path.isdir(args.folder):
+        parser.error(f"not a folder: {args.folder}")
+    if not (args.structure or args.content or args.counts):
+        args.structure = args.content = args.counts = True
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    log = print
+
+    metrics = Instrumentation(profile=args.profile) if args.metrics or args.profile else None
+    defaults = () if args.no_default_ignores else DEFAULT_IGNORES
+    if args.git or args.since:
+        # git has applied .gitignore already; the default and custom patterns still apply
+        matcher = IgnoreMatcher(defaults, args.ignore)
+
+        def build(matcher):
+            return DirectorySnapshot.from_git(args.folder, matcher, args.since, not args.no_untracked)
+    else:
+        matcher = IgnoreMatcher(defaults, args.ignore, gitignore=not args.no_gitignore)
+
+        def build(matcher):
+            return DirectorySnapshot.scan(args.folder, matcher)
+    try:
+        snapshot = metrics.timed_listing(matcher, build) if metrics is not None else build(matcher)
+    except GitError as e:
+        print(f"error: {str(e)}", file=sys.stderr)
+        return 2
+    for path, error in snapshot.errors:
+        log(f"Error accessing {path}: {error}")
+
+    if args.selection:
+        rules = SelectionProfiles(args.selections).rules(args.selection)
+        if rules is None:
+            print(f"error: no selection profile named {args.selection!r} in {args.selections}", file=sys.stderr)
+            return 2
+        selected_files = select_by_rules(snapshot, rules)
+    else:
+        selected_files = [entry.path for entry, _ in snapshot.walk()]
+
+    options = CollationOptions(
+        remove_comments=args.remove_comments,
+        size_limit=max(0, args.max_file_size) * 1024,
+        parallel=args.parallel,
+        workers=args.workers or None,
+        batch_size=max(1, args.batch_size),
+        cache_path=args.cache,
+        chunk_bytes=max(0, args.chunk_kb) * 1024,
+        chunk_tokens=max(0, args.chunk_tokens),
+        output_format=args.format,
+        non_text=args.non_text,
+        incremental=args.incremental,
+        dedup=args.dedup,
+        prefetch=max(0, args.prefetch),
+        prefetch_bytes=max(1, args.prefetch_mb) * 1024 * 1024,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def output(flag, name):
+        return os.path.join(args.output_dir, name) if flag else None
+
+    def report_progress(update):
+        sys.stderr.write(f"\r{update.describe()}\x1b[K")
+        if update.files_done == update.files_total:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+
+    progress = report_progress if args.progress else None
+
+    collate(snapshot, selected_files,
+            structure_file=output(args.structure, 'file_structure.txt'),
+            content_file=output(args.content, CONTENT_FILE_NAMES[args.format]),
+            counts_file=output(args.counts, 'line_counts.txt'),
+            options=options, log=log, progress=progress, metrics=metrics)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())